@@ -4,18 +4,15 @@ os.chdir(os.path.dirname(__file__))
 sys.path.append('..')
 import libcompiler
 from libcompiler import (
-		set_font, set_npress_array, get_disassembly, get_commands,
-		read_rename_list, set_symbolrepr, get_rom,
+		set_font, set_npress_array, load_tables, set_symbolrepr, get_rom,
 		optimize_gadget, find_equivalent_addresses,
 		to_font, print_addresses,
 		process_program,load_defs
 		)
 #get_rom('rom.bin')
 get_rom('rom.bin')
-get_disassembly('disas.txt')
-get_commands('gadgets')
-read_rename_list('labels')
-read_rename_list('../labels_sfr')
+load_tables('disas.txt', 'gadgets', ('labels', '../labels_sfr'),
+		snapshot='tables.snapshot')
 if os.path.exists('def.txt'):
     load_defs('def.txt')
 FONT=[l.split('\t') for l in '''
@@ -80,38 +77,49 @@ symbols = [
 
 set_symbolrepr(symbols[:])
 
+OVERFLOW_INITIAL_SP = 0xE330
+# RAM the sections of a program are placed in, as (start, end)
+RAM_REGIONS = libcompiler.read_ram_regions('880btg')
+
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-t', '--target', default='none',
-		choices=('none',),
-		help='how will the output be used')
-parser.add_argument('-f', '--format', default='key',
-		choices=('hex', 'key'),
-		help='output format')
-parser.add_argument('-g', '--gadget-adr', default=None,
-		type=lambda x:int(x,0), help='Address of gadget to optimize')
-parser.add_argument('-gb', '--gadget-bin', default=None, help='Gadget in binary (big endian)')
-parser.add_argument('-gn', '--gadget-nword', default=0,
-		type=lambda x:int(x,0), help='Length of gadget to optimize (inf if not provided)')
-parser.add_argument('-p', '--preview-count', default=0,
-		type=lambda x:int(x,0), help='Number of lines to preview (optimize gadget mode)')
-args = parser.parse_args()
-
-if args.gadget_bin!=None:
-	assert args.gadget_bin
-	print_addresses(optimize_gadget(bytes.fromhex(args.gadget_bin)), args.preview_count)
-
-elif args.gadget_nword>0:
-	print_addresses(
-		optimize_gadget(libcompiler.rom[args.gadget_adr:args.gadget_adr+args.gadget_nword*2]),
-		args.preview_count)
-
-elif args.gadget_adr!=None:
-	print_addresses(
-		find_equivalent_addresses(libcompiler.rom,{args.gadget_adr}),
-		args.preview_count)
-
-else:
-	program = sys.stdin.read().split('\n')
-	process_program(args, program, overflow_initial_sp=0xE330)
+def main(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-t', '--target', default='none',
+			choices=('none',),
+			help='how will the output be used')
+	parser.add_argument('-f', '--format', default='key',
+			choices=('hex', 'key', 'json'),
+			help='output format')
+	parser.add_argument('-O', '--optimize', action='store_true',
+			help='shrink the program (merge pops, drop dead pops and setlr)')
+	parser.add_argument('-g', '--gadget-adr', default=None,
+			type=lambda x:int(x,0), help='Address of gadget to optimize')
+	parser.add_argument('-gb', '--gadget-bin', default=None, help='Gadget in binary (big endian)')
+	parser.add_argument('-gn', '--gadget-nword', default=0,
+			type=lambda x:int(x,0), help='Length of gadget to optimize (inf if not provided)')
+	parser.add_argument('-p', '--preview-count', default=0,
+			type=lambda x:int(x,0), help='Number of lines to preview (optimize gadget mode)')
+	args = parser.parse_args(argv)
+
+	if args.gadget_bin!=None:
+		assert args.gadget_bin
+		print_addresses(optimize_gadget(bytes.fromhex(args.gadget_bin)), args.preview_count)
+
+	elif args.gadget_nword>0:
+		print_addresses(
+			optimize_gadget(libcompiler.rom[args.gadget_adr:args.gadget_adr+args.gadget_nword*2]),
+			args.preview_count)
+
+	elif args.gadget_adr!=None:
+		print_addresses(
+			find_equivalent_addresses(libcompiler.rom,{args.gadget_adr}),
+			args.preview_count)
+
+	else:
+		program = sys.stdin.read().split('\n')
+		process_program(args, program, overflow_initial_sp=OVERFLOW_INITIAL_SP,
+				ram_regions=RAM_REGIONS)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,348 @@
+'''Pool of warmed compiler worker processes.
+
+Starting `<model>/compiler_.py` for every program means reading `rom.bin`,
+parsing `gadgets`, `labels`, `../labels_sfr` and building the character
+table again and again. A worker of this pool loads a model once and then
+compiles the programs it receives over a pipe, giving back the same
+(returncode, stdout, stderr) triple as running `compiler_.py` would.
+
+LocalCompiler does the same in the current process: each program gets its
+own CompilerSession, so threads can compile at the same time.
+
+`compile_with_map` is for the live editor. It also returns where the bytes
+of every line are, and the compiler keeps the parsed program of the last
+MAX_EDITOR_SESSIONS editor sessions, so that a program compiled again after
+an edit only has its changed lines parsed again. `complete` gives the names
+of the model starting with a prefix, for the autocompletion of the editor.
+
+A program evaluating Python (`$`) can change the model and the modules of
+the process compiling it, for the programs compiled after it. A worker is
+replaced after such a program, and LocalCompiler refuses them.
+
+Worker usage (started by CompilerPool):
+    python compiler_pool.py <model directory>
+'''
+import argparse
+import importlib.util
+import io
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import libcompiler
+
+_load_lock = threading.Lock()
+
+MAX_EDITOR_SESSIONS = 64
+EVAL_REFUSED = 'Error: Python evaluation (`$`) is not available in this compiler\n'
+
+
+def load_model(model_dir):
+    ''' Run `<model_dir>/compiler_.py` in this process.
+
+    Return (module, model). The module gives the model specific settings
+    such as OVERFLOW_INITIAL_SP, the model gives the tables.
+    '''
+    model_dir = os.path.abspath(model_dir)
+    # `compiler_.py` chdirs and fills the tables of libcompiler
+    with _load_lock:
+        cwd = os.getcwd()
+        libcompiler.commands.clear()
+        libcompiler.datalabels.clear()
+        sys.path.insert(0, model_dir)
+        try:
+            spec = importlib.util.spec_from_file_location(
+                'compiler_' + os.path.basename(model_dir),
+                os.path.join(model_dir, 'compiler_.py'))
+            compiler = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(compiler)
+            return compiler, libcompiler.Model.current()
+        finally:
+            sys.path.remove(model_dir)
+            # each model has its own character table
+            sys.modules.pop('get_char_table', None)
+            os.chdir(cwd)
+
+
+def evaluates_python(code):
+    ''' Return True if a statement of the program `code` evaluates Python
+    (`$`), see CompilerSession.parse. '''
+    if '$' not in code:
+        return False
+    for input_line in code.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        if '$' not in input_line:
+            continue
+        try:
+            statements = libcompiler.lex_line(input_line)
+        except Exception:
+            # the compile stops at this line before evaluating it
+            continue
+        if any('$' in line and not line.startswith('str') for line in statements):
+            return True
+    return False
+
+
+class _ParseCaches:
+    ''' The ParseCache of the last MAX_EDITOR_SESSIONS editor sessions. '''
+
+    def __init__(self):
+        self._caches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session):
+        with self._lock:
+            cache = self._caches.pop(session, None)
+            if cache is None:
+                cache = libcompiler.ParseCache()
+            self._caches[session] = cache
+            while len(self._caches) > MAX_EDITOR_SESSIONS:
+                self._caches.popitem(last=False)
+        return cache
+
+
+def _compile(compiler, model, code, fmt, parse_cache=None, optimize=False):
+    ''' Compile one program. Return (returncode, stdout, stderr, info).
+
+    info has the `home` address and the `sourcemap`, a list of
+    (line number, start, end): the bytes [start:end[ after `home` come
+    from that line (numbered from 1).
+
+    With fmt 'json', stdout is one JSON object, see CompilerSession.summary.
+    With optimize, the program is shrunk first, see libcompiler.peephole.
+    '''
+    stdout, stderr = io.StringIO(), io.StringIO()
+    # no colors: a session only uses them when given terminal_colors()
+    session = libcompiler.CompilerSession(model, out=stdout, err=stderr)
+    args = argparse.Namespace(target='none', format=fmt, optimize=optimize)
+    # like `subprocess.run(..., text=True)` does with the input
+    program = code.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    try:
+        session.process_program(args, program, compiler.OVERFLOW_INITIAL_SP,
+                                parse_cache=parse_cache, ram_regions=compiler.RAM_REGIONS)
+        returncode = 0
+    except Exception:
+        traceback.print_exc(file=session.err)
+        returncode = 1
+    info = {'home': session.home, 'sourcemap': session.source_map}
+    return returncode, stdout.getvalue(), stderr.getvalue(), info
+
+
+def _compile_job(compiler, model, job, parse_caches):
+    ''' Compile a job of CompilerPool. Return the result to send back. '''
+    if 'complete' in job:
+        return model.names.complete(job['complete'], job['limit'])
+    session = job.get('session')
+    optimize = job.get('optimize', False)
+    if session is None:
+        return _compile(compiler, model, job['code'], job['format'], optimize=optimize)[:3]
+    parse_cache = parse_caches.get(session)
+    with parse_cache.lock:
+        return _compile(compiler, model, job['code'], job['format'], parse_cache, optimize)
+
+
+def _worker_main(model_dir):
+    ''' Serve compile jobs read from stdin until it is closed. '''
+    jobs = sys.stdin.buffer
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    # anything printed outside of a job must not corrupt the results
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    sys.argv = [os.path.join(model_dir, 'compiler_.py')]
+    parse_caches = _ParseCaches()
+    try:
+        compiler, model = load_model(model_dir)
+        error = None
+    except BaseException:
+        # report the error for every job, like a failing `compiler_.py` would
+        error = traceback.format_exc()
+
+    while True:
+        try:
+            job = pickle.load(jobs)
+        except EOFError:
+            break
+
+        if error is not None and 'complete' in job:
+            result = []
+        elif error is not None:
+            result = (1, '', error) if job.get('session') is None else (1, '', error, {})
+        else:
+            result = _compile_job(compiler, model, job, parse_caches)
+        pickle.dump(result, results)
+        results.flush()
+
+
+class _Worker:
+    def __init__(self, model_dir):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), model_dir],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.results = queue.Queue()
+        self.jobs = 0
+        threading.Thread(target=self._read_results, daemon=True).start()
+
+    def _read_results(self):
+        while True:
+            try:
+                result = pickle.load(self.process.stdout)
+            except Exception:  # EOF: the worker exited
+                self.results.put(None)
+                return
+            self.results.put(result)
+
+    def submit(self, job):
+        pickle.dump(job, self.process.stdin)
+        self.process.stdin.flush()
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class CompilerPool:
+    ''' A fixed number of worker processes compiling for one model.
+
+    Each worker is replaced by a fresh one after `max_jobs` programs, or
+    when it times out or dies.
+    '''
+
+    def __init__(self, model_dir, size=2, max_jobs=500):
+        assert size > 0, 'Pool size must be positive'
+        self.model_dir = os.path.abspath(model_dir)
+        self.size = size
+        self.max_jobs = max_jobs
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def start(self):
+        ''' Start the workers. They load the model in the background. '''
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+        return self
+
+    def _spawn(self):
+        worker = _Worker(self.model_dir)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker, kill=False):
+        with self._lock:
+            self._workers.remove(worker)
+        if kill:
+            worker.process.kill()
+        worker.stop()
+        self._idle.put(self._spawn())
+
+    def compile(self, code, fmt='hex', timeout=15, optimize=False):
+        ''' Compile `code`. Return (returncode, stdout, stderr).
+
+        Raise TimeoutError if no result is available after `timeout` seconds.
+        '''
+        return self._run({'code': code, 'format': fmt, 'optimize': optimize}, timeout)
+
+    def compile_with_map(self, code, session, fmt='hex', timeout=15, optimize=False):
+        ''' Compile `code`, a new version of the program of the editor
+        `session`. Return (returncode, stdout, stderr, info), see `_compile`.
+
+        Each worker keeps its own parsed programs, so the fewer workers the
+        more often an edit is compiled by the worker that saw the last one.
+        '''
+        job = {'code': code, 'format': fmt, 'session': session, 'optimize': optimize}
+        return self._run(job, timeout)
+
+    def complete(self, prefix, limit=20, timeout=15):
+        ''' Return up to `limit` names of the model starting with `prefix`,
+        see NameIndex.complete. '''
+        return self._run({'complete': prefix, 'limit': limit}, timeout)
+
+    def _run(self, job, timeout):
+        evaluates = 'code' in job and evaluates_python(job['code'])
+        # `timeout` covers both waiting for a worker and for its result
+        deadline = time.monotonic() + timeout
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('no idle compiler worker') from None
+
+        try:
+            worker.submit(job)
+            result = worker.results.get(timeout=max(0, deadline - time.monotonic()))
+        except OSError:
+            result = None
+        except queue.Empty:
+            self._retire(worker, kill=True)
+            raise TimeoutError('compile timeout') from None
+        if result is None:
+            self._retire(worker, kill=True)
+            raise RuntimeError('compiler worker died')
+
+        worker.jobs += 1
+        if evaluates or worker.jobs >= self.max_jobs:
+            self._retire(worker)
+        else:
+            self._idle.put(worker)
+        return result
+
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+
+
+class LocalCompiler:
+    ''' Compile for one model in the calling thread, with the same interface
+    as CompilerPool.
+
+    The model is loaded once; every program gets its own CompilerSession.
+    Compiling cannot be interrupted, so `timeout` is not enforced, and
+    programs evaluating Python (`$`) are refused.
+    '''
+
+    def __init__(self, model_dir):
+        self.model_dir = os.path.abspath(model_dir)
+        self.compiler = self.model = None
+        self._parse_caches = _ParseCaches()
+
+    def start(self):
+        self.compiler, self.model = load_model(self.model_dir)
+        return self
+
+    def compile(self, code, fmt='hex', timeout=15, optimize=False):
+        ''' Compile `code`. Return (returncode, stdout, stderr). '''
+        if evaluates_python(code):
+            return 1, '', EVAL_REFUSED
+        return _compile(self.compiler, self.model, code, fmt, optimize=optimize)[:3]
+
+    def compile_with_map(self, code, session, fmt='hex', timeout=15, optimize=False):
+        ''' Like CompilerPool.compile_with_map. '''
+        if evaluates_python(code):
+            return 1, '', EVAL_REFUSED, {}
+        job = {'code': code, 'format': fmt, 'session': session, 'optimize': optimize}
+        return _compile_job(self.compiler, self.model, job, self._parse_caches)
+
+    def complete(self, prefix, limit=20, timeout=15):
+        ''' Like CompilerPool.complete. '''
+        return self.model.names.complete(prefix, limit)
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    _worker_main(sys.argv[1])
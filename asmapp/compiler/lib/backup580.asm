@@ -0,0 +1,7 @@
+# backup580: copy the program from `src` to `backup`
+backup:
+call pop xr0
+{backup}
+adr_of [{src}]
+call 0x09450
+pr_length
@@ -0,0 +1,8 @@
+# backup880: copy the program from `src` to `backup`
+backup:
+call pop xr0
+{backup}
+adr_of [{src}]
+call 0x14DE8
+pr_length
+0x0000
@@ -0,0 +1,20 @@
+# loop580(<remaining length>): restore the program at `src` from `backup`
+# and start it again
+params: remaining
+set_segment:
+setlr
+di,rt
+call pop xr0
+adr_of [length]
+0x0001
+[er0]=er2,rt
+call pop qr0
+pr_length
+{backup}
+adr_of [{src}]
+adr_of [{src}] [-2]
+0x8932
+length:
+hex {remaining}
+0x0000
+sp=er6,pop er8
@@ -0,0 +1,19 @@
+# loop880: restore the program at `src` from `backup` and start it again
+set_segment:
+setlr
+di,rt
+call pop xr0
+adr_of [length]
+0x0001
+[er0]=er2,rt
+loop:
+call pop qr0
+adr_of [{src}]
+{backup}
+pr_length
+adr_of [{src}] [-2]
+hex e6 4d
+length:
+remaining_length
+0x0000
+call sp=er6,pop er8
@@ -0,0 +1,16 @@
+# setup_loop <src>, <backup>[, <label>]: restore the program at `src` from
+# `backup`, then jump to `label`
+params: src, backup, label
+restore:
+    setlr
+    DI,RT
+    xr0 = adr_of [length], 0x01, 0x00
+    [er0] = er2,rt
+    qr0 = pr_length, {backup}, adr_of [{src}], 0x0000
+    0x8932
+length:
+    0x0800
+    0x0000
+set_sp:
+    er6 = adr_of [{label}] [-2]
+    sp = er6,pop er8
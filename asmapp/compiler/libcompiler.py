@@ -1,14 +1,23 @@
 #modified by hieuxyz(comment,supported by casio2k9) last modified at 12:09 AM 11-22-2024(GMT+7)
 #Edit by hienhung05 (adr_of [addr1->addr2],loop580,loop880,backup580,backup880)
 #Edit by minh12312 (adr_of(label, offset, base_address), program_info output (Program is end at,...))
-from colorama import init, Fore, Back, Style
+import ast
+import hashlib
+import json
+import operator
 import os
 import re
+import struct
 import sys
+import threading
+from bisect import bisect_right
 from text import char_to_hex 
+from romindex import get_xref_index, get_word_index
+from nameindex import NameIndex
+from array import array
+from collections import Counter, OrderedDict, namedtuple
 from functools import lru_cache
 
-init()
 max_call_adr = 0xfffff
 
 def set_font(font_):
@@ -23,8 +32,13 @@ def to_font(charcodes):
     return ''.join(font[charcode] for charcode in charcodes)
 
 def set_npress_array(npress_):
-    global npress
+    global npress, word_npress
     npress = npress_
+    word_npress = make_word_npress(npress)
+
+def make_word_npress(npress):
+    ''' Return the number of keypresses of every 16-bit word, indexed by the word. '''
+    return array('H', [npress[lo] + npress[hi] for hi in range(256) for lo in range(256)])
 
 def set_symbolrepr(symbolrepr_):
     global symbolrepr
@@ -39,23 +53,6 @@ def byte_to_key(byte):
     sym = symbolrepr[byte]
     return f'<{byte:02x}>' if sym in ('@', '') else sym
 
-    offset = 0
-    sym = symbolrepr[byte]
-    while byte and npress[byte] >= 100:
-        byte = byte - 1
-        offset += 1
-    typesym = symbolrepr[byte] if byte else 'NUL'
-
-    if set(sym) & set('\'"<>:'):
-        sym = repr(sym)
-    if set(typesym) & set('\'"<>:+'):
-        typesym = repr(typesym)
-
-    if offset == 0:
-        return sym
-    else:
-        return f'<{sym}:{typesym}+{offset}>'
-
 def get_npress(charcodes):
     if isinstance(charcodes, int):
         charcodes = (charcodes,)
@@ -63,9 +60,10 @@ def get_npress(charcodes):
 
 def get_npress_adr(adrs):
     if isinstance(adrs, int):
-        adrs = (adrs,)
+        assert 0 <= adrs <= max_call_adr
+        return word_npress[adrs & 0xFFFF]
     assert all(0 <= adr <= max_call_adr for adr in adrs)
-    return sum(get_npress((adr & 0xFF, (adr >> 8) & 0xFF)) for adr in adrs)
+    return sum(word_npress[adr & 0xFFFF] for adr in adrs)
 
 def optimize_adr_for_npress(adr):
     '''
@@ -75,12 +73,43 @@ def optimize_adr_for_npress(adr):
     '''
     return min((adr, adr ^ 1), key=get_npress_adr)
 
+def split_sum_for_npress(npress, total):
+    '''
+    Return (a, b) such that a + b == total (mod 0x10000) and 0x0101 <= a,
+    with the fewest key strokes, and the smallest a among those.
+
+    The low bytes and the high bytes can be picked apart: only the borrow
+    from subtracting the low bytes links them.
+    '''
+    total_lo, total_hi = total & 0xFF, (total >> 8) & 0xFF
+    # (borrow, whether a low byte of 0 is allowed) -> (key strokes, low byte)
+    best_lo = {}
+    for lo in range(256):
+        borrow = int(lo > total_lo)
+        cost = npress[lo] + npress[(total_lo - lo) & 0xFF]
+        for zero_allowed in (True, False):
+            if lo == 0 and not zero_allowed:
+                continue
+            best = best_lo.get((borrow, zero_allowed))
+            if best is None or cost < best[0]:
+                best_lo[borrow, zero_allowed] = cost, lo
+
+    best = None  # (key strokes, a)
+    for hi in range(1, 256):
+        zero_allowed = hi != 1  # a >= 0x0101
+        for borrow in (0, 1):
+            if (borrow, zero_allowed) not in best_lo:
+                continue
+            cost, lo = best_lo[borrow, zero_allowed]
+            cost += npress[hi] + npress[(total_hi - hi - borrow) & 0xFF]
+            if best is None or (cost, hi << 8 | lo) < best:
+                best = cost, hi << 8 | lo
+    a = best[1]
+    return a, (total - a) % 0x10000
+
 def optimize_sum_for_npress(total):
     ''' Return (a, b) such that a + b == total. '''
-    return ['0x' + hex(x)[2:].zfill(4) for x in min(
-        ((x, (total - x) % 0x10000) for x in range(0x0101, 0x10000)),
-        key=get_npress_adr
-    )]
+    return ['0x' + hex(x)[2:].zfill(4) for x in split_sum_for_npress(npress, total)]
 
 def note(st):
     ''' Print st to stderr. Used for additional information (note, warning) '''
@@ -271,637 +300,1585 @@ def read_rename_list(filename):
         else:
             raise ValueError('Invalid line: ' + repr(line))
 
+# A snapshot is SNAPSHOT_MAGIC, a JSON line {"version", "sources"} and the
+# tables as JSON. Bump the version when the tables change shape or meaning.
+SNAPSHOT_MAGIC = b'libcompiler tables\n'
+SNAPSHOT_VERSION = 3
+
+def sources_digest(filenames):
+    ''' Return {filename: sha256 of its content}. '''
+    digests = {}
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            digests[filename] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+def read_snapshot(snapshot, header):
+    ''' Return the tables in the file `snapshot`, or None if it is missing,
+    damaged, or its header is not `header`. The header is checked before the
+    tables are read. '''
+    try:
+        with open(snapshot, 'rb') as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return None
+            if json.loads(f.readline()) != header:
+                return None
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+def load_tables(disassembly, gadgets, rename_lists, snapshot):
+    '''Fill `disasm`, `commands` and `datalabels` from the given files.
+
+    The parsed tables are saved in the file `snapshot` and read back from it
+    while the source files keep the same hashes, instead of parsing them
+    again. Return True if the snapshot was used.
+    '''
+    global disasm
+    header = {'version': SNAPSHOT_VERSION,
+              'sources': sources_digest((disassembly, gadgets, *rename_lists))}
+    data = read_snapshot(snapshot, header)
+    if data is not None:
+        disasm = data['disasm']
+        commands.update((name, (adr, tuple(tags))) for name, (adr, tags) in data['commands'].items())
+        datalabels.update(data['datalabels'])
+        return True
+
+    get_disassembly(disassembly)
+    get_commands(gadgets)
+    for filename in rename_lists:
+        read_rename_list(filename)
+
+    data = {
+        'disasm': disasm,
+        'commands': commands,
+        'datalabels': datalabels,
+    }
+    # write to a temporary file first, other processes may be loading it
+    tmp = f'{snapshot}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        os.replace(tmp, snapshot)
+    except OSError:
+        note(f'Warning: Cannot write snapshot {snapshot}\n')
+    return False
+
 def sizeof_register(reg_name):
     # assume reg_name is a valid register name
     return {'r': 1, 'e': 2, 'x': 4, 'q': 8}[reg_name[0]]
-result = []  # list of ints in range 0..255
-labels = {}
-adr_of_cmds = []  # list of (source adr, offset, target label)
-adr_arith_cmds = []  # list of deferred adr_arith commands
-pr_length_cmds = []  # list of deferred pr_length commands
-endaddr = ""
-end = []
-addr = 1
-# Right after the buffer overflow, the memory region [home..home+len(result)[
-# should have value = result (after replacing labels)
-home = None
-in_comment  = False
-# Dictionary to store string variables and their hex values
-string_vars = {}
-pop_check=False
-def process(line):
-    # the processing result will affect those variables
-    global pop_check, result, labels, adr_of_cmds, adr_arith_cmds, pr_length_cmds, home, string_vars, in_comment, endaddr, end
-
-
-    if not line or line.isspace():
-        return
-
-    if line.startswith('/*'):
-        in_comment = True
-        return   
-    if '*/' in line:
-        in_comment = False
-        return
-    if in_comment:
-        return
-
-    elif ';' in line:
-        ''' Compound statement. Syntax:
-        `<statement1> ; <statement2> ; ...`
-        '''
-        for command in line.split(';'):
-            process(to_lowercase(command))
 
-    elif line.strip() and line.strip()[-1] == ':':
-        ''' Syntax: `<label>:`
-        Special: If the label is 'home', it specifies the point to
-        start program execution. By default it's at the begin.
-        '''
-        label = to_lowercase(line[:-1])
-        assert label not in labels, f'Duplicated label: {label}'
-        labels[label] = len(result)
-
-    elif line.startswith('0x'):
-        if '+' in line:
-            ''' Syntax: `0x<hexadecimal digits>+<dec>` '''
-            hex_part, dec_part = line.split('+')
-            initial_value = int(hex_part, 16) 
-            increment = int(dec_part)
-            result_value = initial_value + increment
-            n_byte = len(hex_part) // 2 - 1
-            for _ in range(n_byte):
-                result.append(result_value & 0xFF)
-                result_value >>= 8
-        elif '-' in line:
-            ''' Syntax: `0x<hexadecimal digits>-<dec>` '''
-            hex_part, dec_part = line.split('-')
-            initial_value = int(hex_part, 16)
-            decrement = int(dec_part)
-            result_value = initial_value - decrement
-            n_byte = len(hex_part) // 2 - 1
-            for _ in range(n_byte):
-                result.append(result_value & 0xFF)
-                result_value >>= 8
-        else:
-            ''' Syntax: `0x<hexadecimal digits>` '''
-            assert len(line) % 2 == 0, f'Invalid data length'
-            n_byte = len(line) // 2 - 1
-            data = int(line, 16)
-            for _ in range(n_byte):
-                result.append(data & 0xFF)
-                data >>= 8
-    elif line.startswith('hex') and 'hex_' not in line:
-        data = line[3:].strip()
-        assert len(data.replace(" ", "")) % 2 == 0, f'Invalid data length'
-        data_bytes = bytes.fromhex(data)
-        result.extend(data_bytes)
-
-    elif line.startswith('call'):
-        ''' Syntax: `call <address>` or `call <built-in>`. '''
-        try:
-            adr = int(line[4:], 16)
-        except ValueError:
-            #adr, tags = commands[to_lowercase(line[4:].strip())]
-            adr, tags = commands[line[4:].strip()]
-            for tag in tags:
-                if tag.startswith('warning'):
-                    note(tag + '\n')
-
-        assert 0 <= adr <= max_call_adr, f'Invalid address: {adr}'
-        adr = optimize_adr_for_npress(adr)
-        process(f'0x{adr + 0x00000000:0{8}x}')
-
-    elif line.startswith('goto'):
-        ''' Syntax: `goto <label>` '''
-        label = to_lowercase(line[4:])
-        process(f'er6 = adr_of [-2] {label}')
-        process('call sp=er6,pop er8')
+# The instructions a statement is parsed into, see CompilerSession.parse.
+Data = namedtuple('Data', 'data')  # bytes
+Call = namedtuple('Call', 'adr name')  # 4 bytes; name of the gadget or None
+Label = namedtuple('Label', 'name')
+AdrOf = namedtuple('AdrOf', 'label offset base')  # 2 bytes; base is None or `[base_address]`
+AdrArith = namedtuple('AdrArith', 'left_offset left_label right_offset right_label')  # 1 byte
+PrLength = namedtuple('PrLength', '')  # 2 bytes
+RemainingLength = namedtuple('RemainingLength', '')  # 2 bytes
+Org = namedtuple('Org', 'address')
+Note = namedtuple('Note', 'text')  # for the error stream
+Print = namedtuple('Print', 'text')  # for the output stream
+Link = namedtuple('Link', 'obj')  # an Object
+Section = namedtuple('Section', 'name size align')
+Ram = namedtuple('Ram', 'start end')  # a free RAM region for the sections
+
+# A compiled library entry: bytes with zeroes for the fixups, the labels as
+# (name, offset), the fixups as (offset, AdrOf/AdrArith/PrLength/RemainingLength),
+# the warnings and the offsets of the calls.
+Object = namedtuple('Object', 'name data labels fixups notes calls')
+
+_INSTR_SIZES = {Call: 4, AdrOf: 2, AdrArith: 1, PrLength: 2, RemainingLength: 2}
+_FIXUPS = AdrOf, AdrArith, PrLength, RemainingLength
+
+# Relocation kinds: what `link` writes at result[pos]
+ABS16 = 'abs16'  # 2 bytes: home + labels[label] + offset
+DIFF8 = 'diff8'  # 1 byte: (labels[label] + offset) - (labels[right_label] + right_offset)
+LENGTH16 = 'length16'  # 2 bytes: length of the program
+REMAINING16 = 'remaining16'  # 2 bytes: length of the program from pos
+Reloc = namedtuple('Reloc', 'kind pos label offset right_label right_offset')
+_RELOC_SIZES = {ABS16: 2, DIFF8: 1, LENGTH16: 2, REMAINING16: 2}
+
+def instr_size(instr):
+    ''' Return the number of bytes emitted for instr. '''
+    if type(instr) is Data:
+        return len(instr.data)
+    if type(instr) is Link:
+        return len(instr.obj.data)
+    return _INSTR_SIZES.get(type(instr), 0)
+
+LIBRARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+DECOMPILER_MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     'decompiler', 'models')
+# bytes below the chain that its gadgets may push into, kept out of the sections
+STACK_MARGIN = 0x100
+
+def read_ram_regions(model_name):
+    '''
+    Return the RAM of a model as ((start, end),), end excluded, from
+    `start_ram` and `end_ram` in the config.py of its decompiler model. The
+    file is read, not run.
 
-    elif line.startswith('adr_of'):
-        '''
-        Syntax:
-        - adr_of [label_name] [offset] [base_address]
-        - adr_of [label_name] [offset]
-        - adr_of [label_name]
-        '''
-    
-        line = line[6:].strip()
-        if not line.startswith('['):
-            raise ValueError(f"adr_of line must start with '[', got: {line!r}")
-        else:
-            inner = line[1:-1]
-            parts = re.findall(r'\[([^\]]+)\]', line)
-            label = to_lowercase(parts[0])
-            if len(parts) == 1:
-                offset = 0
-            elif len(parts) == 2:
-                offset=int(parts[1].strip(), 0)
-            elif len(parts) == 3:
-                offset = (int(parts[2].strip(),16)-home)+int(parts[1].strip(),0)
+    The configs do not agree on whether end_ram is in RAM, so it is always
+    taken as excluded: at worst the last byte of RAM is left unused.
+    '''
+    filename = os.path.join(DECOMPILER_MODELS_DIR, model_name, 'config.py')
+    values = {}
+    with open(filename, encoding='utf-8') as f:
+        for node in ast.parse(f.read()).body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                    isinstance(node.targets[0], ast.Name):
+                if node.targets[0].id in ('start_ram', 'end_ram'):
+                    values[node.targets[0].id] = ast.literal_eval(node.value)
+    start, end = values.get('start_ram'), values.get('end_ram')
+    if not (isinstance(start, int) and isinstance(end, int) and 0 <= start < end <= 0x10000):
+        raise ValueError(f'Invalid start_ram/end_ram in {filename}: {start!r}, {end!r}')
+    return ((start, end),)
+
+@lru_cache(maxsize=None)
+def read_library_entry(name):
+    '''
+    Return (parameters, lines) of `<LIBRARY_DIR>/<name>.asm`. A line
+    `params: <name>, ...` declares the parameters, written `{<name>}` in
+    the other lines. `{backup}` and `{src}` are the `backup is` and
+    `src is` values.
+    '''
+    assert re.fullmatch(r'[a-z0-9_]+', name), f'Invalid library entry name: {name}'
+    filename = os.path.join(LIBRARY_DIR, name + '.asm')
+    if not os.path.isfile(filename):
+        raise ValueError(f'Library entry not found: {name}')
+    params = ()
+    lines = []
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('params:'):
+                params = tuple(filter(None, map(str.strip, line[7:].split(','))))
             else:
-                raise ValueError(f"adr_of must have 1–3 arguments, got: {parts}")
-
-            adr_of_cmds.append((len(result), offset, label))
-            result.extend((0, 0))
+                lines.append(line.rstrip('\n'))
+    return params, tuple(lines)
+
+def split_include(text):
+    ''' Split `<name>` or `<name>(<arg>, ...)` into (name, args). '''
+    text = text.strip()
+    if '(' not in text:
+        return text, ()
+    assert text.endswith(')'), f'Invalid include: {text}'
+    name, args = text[:-1].split('(', 1)
+    return name.strip(), tuple(arg.strip() for arg in args.split(',')) if args.strip() else ()
+
+def hex_data(line):
+    ''' Return the bytes of `0x<hexadecimal digits>`, `0x<hexadecimal digits>+<dec>`
+    or `0x<hexadecimal digits>-<dec>`, little endian, as many as the digits. '''
+    if '+' in line:
+        hex_part, dec_part = line.split('+')
+        value = int(hex_part, 16) + int(dec_part)
+    elif '-' in line:
+        hex_part, dec_part = line.split('-')
+        value = int(hex_part, 16) - int(dec_part)
+    else:
+        assert len(line) % 2 == 0, f'Invalid data length'
+        hex_part = line
+        value = int(line, 16)
+    n_byte = len(hex_part) // 2 - 1
+    return (value & ~(-1 << 8 * n_byte)).to_bytes(n_byte, 'little')
+
+def word_data(value):
+    ''' Return the bytes of a data label address, 2 of them unless it needs more. '''
+    assert value >= 0, f'Invalid address: {value}'
+    n_digit = max(4, (value.bit_length() + 3) // 4)
+    assert n_digit % 2 == 0, f'Invalid data length'
+    return value.to_bytes(n_digit // 2, 'little')
+
+def lex_program(program, lex=None):
+    '''
+    Return the statements of a program (list of command lines) as a list of
+    (line number, statement). `lex` splits a line, `lex_line` by default.
+    '''
+    lex = lex or lex_line
+    return [(lineno, line)
+            for lineno, input_line in enumerate(program, 1)
+            for line in lex(input_line)]
 
-    elif line in datalabels:
-        ''' `<label>`. '''
-        process(f'{line}+0')
+def lex_line(input_line):
+    '''
+    Return the statements of a command line: without comments, canonical,
+    and lowercase unless they are a `str`. A `setup_loop` line becomes an
+    `include` of the library entry `setup_loop`.
+    '''
+    line = canonicalize(del_inline_comment(input_line))
+    if line.startswith('setup_loop'):
+        parts = line.split(',')
+        if len(parts) == 2:  # Chính xác 2 phần
+            src = parts[0].split()[1].strip()
+            src_backup = parts[1].strip()
+            label = 'home'  # Mặc định
+        elif len(parts) == 3:  # Chính xác 3 phần 
+            src = parts[0].split()[1].strip()
+            src_backup = parts[1].strip()
+            label = parts[2].strip() if parts[2].strip() != 'None' else 'home'
+        else:
+            raise ValueError(f'Invalid setup_loop directive: {line} - Expected 2 or 3 parts')
 
-    elif '+' in line and line[:line.find('+')] in datalabels:
-        ''' `<label> + <offset>`. '''
-        label, offset = line.split('+')
-        process(f'0x{datalabels[label] + int(offset, 0):04x}')
+        line = f'include setup_loop({src},{src_backup},{label})'
 
-    elif line in commands:
-        ''' `<built-in>`. Equivalent to `call <built-in>`. '''
+    # Chỉ sử dụng to_lowercase nếu dòng không bắt đầu bằng "str"
+    if not line.lower().startswith("str"):
         line = to_lowercase(line)
-        process('call ' + line)
+    return [line]
+
+PARSE_MEMO_SIZE = 4096
+OBJECT_CACHE_SIZE = 256
+
+class MemoCache:
+    ''' Values by key, dropping the least recently used ones beyond
+    `max_entries`. Shared by the sessions of a model, from any thread. '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class Model:
+    ''' The tables of one calculator model, read by the sessions compiling
+    for it. They are never modified after the model is loaded. '''
+
+    def __init__(self, commands, datalabels, npress, symbolrepr, word_npress=None, rom=None):
+        self.commands = commands
+        self.datalabels = datalabels
+        self.npress = npress
+        self.word_npress = make_word_npress(npress) if word_npress is None else word_npress
+        # 1 for the addresses in 0..0x1FFFF taking 100 key strokes or more
+        self.slow_adrs = array('I', [cost >= 100 for cost in self.word_npress]) * 2
+        self.symbolrepr = symbolrepr
+        self.byte_to_key = lru_cache(maxsize=256)(self._byte_to_key)
+        self.rom = rom
+        # gadget address -> the address to call for it, see call_for_npress
+        self.call_for_npress = lru_cache(maxsize=4096)(self._call_for_npress)
+        # (statement, backup, src) -> instructions, see CompilerSession.process
+        self.parse_memo = MemoCache(PARSE_MEMO_SIZE)
+        # (library entry, arguments) -> Object, see CompilerSession.library_object
+        self.objects = MemoCache(OBJECT_CACHE_SIZE)
+        # the gadget, function, SFR and data label names, for suggestions
+        self.names = NameIndex([*commands, *datalabels])
+
+    @classmethod
+    def current(cls):
+        ''' Return a model of the tables loaded by `get_commands`,
+        `read_rename_list`, `set_npress_array` and `set_symbolrepr`. '''
+        return cls(dict(commands), dict(datalabels), npress, symbolrepr, word_npress, rom)
+
+    def _byte_to_key(self, byte):
+        if byte == 0:
+            return '<NUL>'
+        sym = self.symbolrepr[byte]
+        return f'<{byte:02x}>' if sym in ('@', '') else sym
+
+    def get_npress(self, charcodes):
+        if isinstance(charcodes, int):
+            charcodes = (charcodes,)
+        return sum(self.npress[charcode] for charcode in charcodes)
+
+    def get_npress_adr(self, adrs):
+        if isinstance(adrs, int):
+            assert 0 <= adrs <= max_call_adr
+            return self.word_npress[adrs & 0xFFFF]
+        assert all(0 <= adr <= max_call_adr for adr in adrs)
+        return sum(self.word_npress[adr & 0xFFFF] for adr in adrs)
+
+    def optimize_adr_for_npress(self, adr):
+        return min((adr, adr ^ 1), key=self.get_npress_adr)
+
+    def call_npress(self, adr):
+        ''' Return the number of key strokes of the 4 bytes of `call adr`. '''
+        return self.word_npress[adr & 0xFFFF] + self.npress[adr >> 16] + self.npress[0]
+
+    def jump_sources(self, adr):
+        '''
+        Return adr and the addresses of the unconditional branches (B, BC AL)
+        leading to it, directly or not: calling any of them runs the same
+        code. A BL followed by POP PC is not one of them, it changes LR.
+        '''
+        rom = self.rom
+        index = get_xref_index(rom)
+        found, pending = {adr}, [adr]
+        while pending:
+            for source in index.comefrom(pending.pop()):
+                is_bl = rom[source] == 0x01 and rom[source + 1] & 0xf0 == 0xf0
+                if source not in found and not is_bl:
+                    found.add(source)
+                    pending.append(source)
+        return found
+
+    def _call_for_npress(self, adr):
+        '''
+        Return the address to call instead of adr with the fewest key
+        strokes: adr with either lowest bit, or one of its jump_sources.
+        adr itself is kept on ties.
+        '''
+        if self.rom is None or adr >= len(self.rom):
+            return self.optimize_adr_for_npress(adr)
+        candidates = (source | bit for source in self.jump_sources(adr & ~1) for bit in (0, 1))
+        return min(candidates, key=lambda c: (self.call_npress(c), c != adr, c))
 
-    elif line.startswith('pop'):
-        ''' Syntax:
-        `pop register (hex)
+    def pick_home(self, homes, home_offsets):
         '''
-        i = line.index('(')
-        lb = line.rindex(')')
-        register, value = line[4:i], line[i + 1:lb].lstrip()
-        process(f'call pop {register}')
-        value=value.replace(',',';')
-        l1 = len(result)
-        process(value)
-        assert len(result) - l1 == sizeof_register(register), \
-            f'Line {line!r} source/destination target mismatches'
-    elif '=' in line:
-        ''' Syntax:
-        `reg = (hex)
+        Return the home in `homes` (a range) with the fewest addresses
+        `home + offset` taking 100 key strokes or more, the highest home
+        among those.
         '''
-        i = line.index('=')
-        register, value = line[:i], line[i+1:].lstrip()
-        process(f'call pop {register}')
-        value=value.replace(',',';')
-        l1 = len(result)
-        process(value)
-        assert len(result) - l1 == sizeof_register(register), \
-            f'Line {line!r} source/destination target mismatches'
+        offsets = Counter(home_offsets)
+        if any(homes.start + offset < 0 or homes.stop + offset > len(self.slow_adrs)
+               for offset in offsets):
+            return min(homes, key=lambda home: (
+                sum(self.get_npress_adr(home + offset) >= 100 for offset in home_offsets),
+                -home))
+
+        # Add up the slow_adrs of every home at once: each slice is read as
+        # one big integer with a 32-bit counter per home.
+        counts = 0
+        for offset, n in offsets.items():
+            lanes = self.slow_adrs[homes.start + offset:homes.stop + offset:homes.step]
+            counts += n * int.from_bytes(lanes.tobytes(), sys.byteorder)
+        counts = array('I', counts.to_bytes(4 * len(homes), sys.byteorder))
+        fewest = min(counts)
+        return homes[len(counts) - 1 - counts[::-1].index(fewest)]
+
+    def optimize_sum_for_npress(self, total):
+        ''' Return (a, b) such that a + b == total. '''
+        return ['0x' + hex(x)[2:].zfill(4) for x in split_sum_for_npress(self.npress, total)]
+
+class NoColors:
+    ''' Stands for colorama.Fore when the output is not a terminal. '''
+    GREEN = CYAN = WHITE = RED = ''
+
+@lru_cache(maxsize=None)
+def terminal_colors():
+    ''' Return colorama.Fore, colorama being set up once. Only the command
+    line uses colors, the server does not import colorama. '''
+    from colorama import init, Fore
+    init()
+    return Fore
+
+class CompilerSession:
+    ''' The state of compiling one program.
+
+    Sessions share their model, so that any number of them can compile at
+    the same time, each in its own thread. `define_cmd` and `define_gadget`
+    only change the commands of the session.
+    '''
 
-    elif line[0] == '$':
-        ''' Python eval. The result will be processed as commands. '''
-        x = eval(line[1:])
-        if isinstance(x, str):
-            process(x)
-        elif isinstance(x, list) or isinstance(x, tuple):
-            for command in x:
-                process(command)
+    def __init__(self, model, out=None, err=None, colors=NoColors):
+        self.model = model
+        self.out = sys.stdout if out is None else out
+        self.err = sys.stderr if err is None else err
+        self.colors = colors
+        self.commands = model.commands
+        self.datalabels = model.datalabels
+        self.result = bytearray()
+        self.labels = {}
+        # list of Reloc, resolved by `link`
+        self.relocs = []
+        self.addr = 1
+        # Right after the buffer overflow, the memory region [home..home+len(result)[
+        # should have value = result (after replacing labels)
+        self.home = None
+        self.in_comment = False
+        # Dictionary to store string variables and their hex values
+        self.string_vars = {}
+        self.pop_check = False
+        # set by `org`, `backup is` and `src is`
+        self.hx = None
+        self.backup = None
+        self.src = None
+        self.note_log = None
+        # set by `parse` when a statement depends on more than the model
+        self.reads_context = False
+        # list of (line number, start, end): result[start:end] comes from that line
+        self.source_map = []
+        # with `-f json`: the notes of the lines, as [line number, text],
+        # and the other notes
+        self.json_output = False
+        self.line_notes = []
+        self.warnings = []
+        # list of [Section, start in result, address]: the bytes from the
+        # start of a section to the start of the next one are placed at its
+        # address by `layout`, the ones before the first section at `home`
+        self.sections = []
+        self.label_sections = {}  # label -> index in sections + 1
+        self.ram = []  # list of (start, end) set by `ram`
+        self.free_ram = []  # what `layout` left free
+        # with `-O`: the instructions `emit` keeps for the optimizer, and
+        # the number of bytes it saved
+        self.deferred = None
+        self.saved = 0
+        # positions of the call addresses in result, and with `-f key` the
+        # number of calls `plan_calls` changed and the key strokes it saved
+        self.calls = []
+        self.planned_calls = 0
+        self.planned_npress = 0
+
+    def note(self, st):
+        ''' Print st to the error stream, or keep it while a line is processed. '''
+        if self.note_log is not None:
+            self.note_log.append(st)
+        else:
+            self.err.write(st)
+
+    def own_tables(self):
+        ''' Copy the commands and data labels before changing them: the model
+        and the states kept by a ParseCache share them. '''
+        self.commands = dict(self.commands)
+        self.datalabels = dict(self.datalabels)
+
+    def parse_state(self):
+        ''' Return what the parsing of the next statement depends on. '''
+        return (self.in_comment, self.backup, self.src, self.string_vars,
+                self.commands, self.datalabels)
+
+    def set_parse_state(self, state):
+        (self.in_comment, self.backup, self.src, self.string_vars,
+         self.commands, self.datalabels) = state
+
+    def process(self, line):
+        ''' Parse one line and emit its instructions. Return the instructions.
+
+        The instructions of a line whose instructions depend on nothing but
+        the line, the tables of the model and the `backup is` and `src is`
+        values (`call <gadget>`, `hex ...`, `0x...`, `reg = ...`,
+        `str "..."`, macros, ...) are kept in the parse memo of the model.
+        '''
+        key = None
+        if (not self.in_comment and self.commands is self.model.commands
+                and self.datalabels is self.model.datalabels):
+            key = line, self.backup, self.src
+            instrs = self.model.parse_memo.get(key)
+            if instrs is not None:
+                for instr in instrs:
+                    self.emit(instr)
+                return instrs
+            state = self.parse_state()
+
+        instrs = []
+        self.reads_context = False
+        for instr in self.parse(line):
+            instrs.append(instr)
+            self.emit(instr)
+        # `is`: a line setting a value again, such as a second `str v "xy"`,
+        # still has to be parsed every time
+        if (key is not None and not self.reads_context
+                and all(map(operator.is_, self.parse_state(), state))):
+            self.model.parse_memo.put(key, tuple(instrs))
+        return instrs
+
+    def parse_call(self, target):
+        ''' Parse the target of `call <address>` or `call <built-in>`. '''
+        try:
+            adr = int(target, 16)
+            name = None
+        except ValueError:
+            name = target.strip()
+            if name not in self.commands:
+                raise ValueError(f'Unknown gadget: {name}{self.model.names.did_you_mean(name)}')
+            adr, tags = self.commands[name]
+            for tag in tags:
+                if tag.startswith('warning'):
+                    yield Note(tag + '\n')
 
-    elif line.startswith('org'):
-        ''' Syntax: `org <expr>`
+        assert 0 <= adr <= max_call_adr, f'Invalid address: {adr}'
+        yield Call(self.model.optimize_adr_for_npress(adr), name)
 
-        Specify the address of this location after mapping.
-        Only use this for loader mode.
+    def parse(self, line):
         '''
-        global hx
-        hx = eval(line[3:])
-        home1 = hx - len(result)
-        assert home is None or home == home1, 'Inconsistent value of `home`'
-        home = home1
-    elif line.startswith('fill'):
-        d=line.rindex(")")
-        parts = line[5:d].split(',')
-        rs='0x'
-        if parts[0].startswith('0x'):
-            parts[0] = parts[0][2:]
-        rs = '0x' + ''.join([parts[0]]*int(parts[1],0))
-        process(rs)
-    elif line.startswith('backup is '):
-        global backup
-        backup = line.replace("backup is ", "").strip()
-    elif line.startswith('src is '):
-        global src
-        src = line.replace("src is ", "").strip()
-    elif line.startswith('loop880'):
-        remaining_length = "hex " + line.replace("loop880(", "")[:-1]
-        heh = f"""set_segment:
-setlr
-di,rt
-call pop xr0 
-adr_of length
-0x0001
-[er0]=er2,rt
-loop:
-call pop qr0
-adr_of {src}
-{backup}
-pr_length
-adr_of [-2] {src}
-hex e6 4d
-length:
-remaining_length
-0x0000
-call sp=er6,pop er8"""
-        huh = heh.splitlines()
-        for i in huh:
-            process(i)
-    elif line.startswith('loop580'):
-        remaining_length = "hex " + line.replace("loop580(", "")[:-1]
-        print(remaining_length)
-        heh = f"""set_segment:
-setlr
-di,rt
-call pop xr0 
-adr_of length
-0x0001
-[er0]=er2,rt
-call pop qr0
-pr_length
-{backup}
-adr_of {src}
-adr_of [-2] {src}
-0x8932
-length:
-{remaining_length}
-0x0000
-sp=er6,pop er8"""
-        huh = heh.splitlines()
-        for i in huh:
-            process(i)
-    elif line.startswith('backup580'):
-        heh = f"""backup:
-call pop xr0
-{backup}
-adr_of {src}
-call 0x09450
-pr_length
-"""
-        huh = heh.splitlines()
-        for i in huh:
-            print(i)
-            process(i)
-    elif line.startswith('backup880'):
-        heh = f"""backup:
-call pop xr0
-{backup}
-adr_of {src}
-call 0x14DE8
-pr_length
-0x0000
-"""
-        huh = heh.splitlines()
-        for i in huh:
-            process(i)
-    elif line.startswith('adr_arith'):
-        ''' Syntax: `adr_arith [offset] <label> - adr_arith [offset] <label>`
+        Parse a statement (see `lex_program`) into instructions, yielded one
+        at a time so that they are emitted in order with the ones of the
+        statements before.
+
+        Declarations (`define_cmd`, `str <var> "..."`, `backup is`, ...)
+        take effect here, the addresses and labels are left to `emit`.
         '''
-        last_minus_pos = len(line) - 1
-        while last_minus_pos > 0:
-            if line[last_minus_pos] == '-' and 'adr_arith' in line[last_minus_pos:]:
-                break
-            last_minus_pos -= 1
+        if not line or line.isspace():
+            return
+
+        if line.startswith('/*'):
+            self.in_comment = True
+            return   
+        if '*/' in line:
+            self.in_comment = False
+            return
+        if self.in_comment:
+            return
+
+        elif ';' in line:
+            ''' Compound statement. Syntax:
+            `<statement1> ; <statement2> ; ...`
+            '''
+            for command in line.split(';'):
+                yield from self.parse(to_lowercase(command))
+
+        elif line.strip() and line.strip()[-1] == ':':
+            ''' Syntax: `<label>:`
+            Special: If the label is 'home', it specifies the point to
+            start program execution. By default it's at the begin.
+            '''
+            yield Label(to_lowercase(line[:-1]))
+
+        elif line.startswith('0x'):
+            ''' Syntax: `0x<hexadecimal digits>`, `0x<hexadecimal digits>+<dec>`
+            or `0x<hexadecimal digits>-<dec>` '''
+            yield Data(hex_data(line))
+        elif line.startswith('hex') and 'hex_' not in line:
+            data = line[3:].strip()
+            assert len(data.replace(" ", "")) % 2 == 0, f'Invalid data length'
+            yield Data(bytes.fromhex(data))
+
+        elif line.startswith('call'):
+            ''' Syntax: `call <address>` or `call <built-in>`. '''
+            yield from self.parse_call(line[4:])
+
+        elif line.startswith('goto'):
+            ''' Syntax: `goto <label>`
+            Same as `er6 = adr_of [-2] <label>` then `sp=er6,pop er8`.
+            '''
+            label = to_lowercase(line[4:].strip())
+            yield from self.parse_call('pop er6')
+            yield AdrOf(label, -2, None)
+            yield from self.parse_call('sp=er6,pop er8')
+
+        elif line.startswith('adr_of'):
+            '''
+            Syntax:
+            - adr_of [label_name] [offset] [base_address]
+            - adr_of [label_name] [offset]
+            - adr_of [label_name]
+            '''
+    
+            line = line[6:].strip()
+            if not line.startswith('['):
+                raise ValueError(f"adr_of line must start with '[', got: {line!r}")
+            else:
+                parts = re.findall(r'\[([^\]]+)\]', line)
+                label = to_lowercase(parts[0])
+                if len(parts) == 1:
+                    yield AdrOf(label, 0, None)
+                elif len(parts) == 2:
+                    yield AdrOf(label, int(parts[1].strip(), 0), None)
+                elif len(parts) == 3:
+                    yield AdrOf(label, int(parts[1].strip(), 0), int(parts[2].strip(), 16))
+                else:
+                    raise ValueError(f"adr_of must have 1–3 arguments, got: {parts}")
+
+        elif line in self.datalabels:
+            ''' `<label>`. '''
+            yield Data(word_data(self.datalabels[line]))
+
+        elif '+' in line and line[:line.find('+')] in self.datalabels:
+            ''' `<label> + <offset>`. '''
+            label, offset = line.split('+')
+            yield Data(word_data(self.datalabels[label] + int(offset, 0)))
+
+        elif line in self.commands:
+            ''' `<built-in>`. Equivalent to `call <built-in>`. '''
+            yield from self.parse_call(to_lowercase(line))
+
+        elif line.startswith('pop'):
+            ''' Syntax:
+            `pop register (hex)
+            '''
+            if '(' not in line:
+                raise ValueError(f'Unknown gadget: {line}{self.model.names.did_you_mean(line)}')
+            i = line.index('(')
+            lb = line.rindex(')')
+            register, value = line[4:i], line[i + 1:lb].lstrip()
+            yield from self.parse_pop(line, register, value)
+        elif '=' in line:
+            ''' Syntax:
+            `reg = (hex)
+            '''
+            i = line.index('=')
+            register, value = line[:i], line[i+1:].lstrip()
+            if f'pop {register.strip()}' not in self.commands:
+                # not an assignment, such as a misspelt `sp = er6,pop er8`;
+                # else parse_pop reports the missing `pop <register>`
+                suggestion = self.model.names.did_you_mean(line)
+                if suggestion:
+                    raise ValueError(f'Unknown gadget: {line}{suggestion}')
+            yield from self.parse_pop(line, register, value)
+
+        elif line[0] == '$':
+            ''' Python eval. The result will be processed as commands. '''
+            self.reads_context = True
+            x = eval(line[1:])
+            if isinstance(x, str):
+                yield from self.parse(x)
+            elif isinstance(x, list) or isinstance(x, tuple):
+                for command in x:
+                    yield from self.parse(command)
+
+        elif line.startswith('org'):
+            ''' Syntax: `org <expr>`
+
+            Specify the address of this location after mapping.
+            Only use this for loader mode.
+            '''
+            yield Org(eval(line[3:]))
+        elif line.startswith('section '):
+            ''' Syntax: `section <name>`, `section <name>(<size>)` or
+            `section <name>(<size>, <align>)`
+
+            The statements after it, up to the next `section`, are placed
+            by the layout solver somewhere in the free RAM (see `ram`),
+            at a multiple of <align>, in <size> bytes at least.
+            '''
+            name, args = split_include(line[8:])
+            assert len(args) <= 2, f'Invalid section: {line}'
+            size, align = [eval(arg) for arg in args] + [0, 1][len(args):]
+            assert align > 0, f'Invalid section alignment: {align}'
+            yield Section(name, size, align)
+        elif line.startswith('ram '):
+            ''' Syntax: `ram <start>, <end>`
+
+            Let the sections use the RAM [start, end[ instead of the RAM
+            of the model. Can be used several times.
+            '''
+            start, end = map(eval, line[4:].split(','))
+            assert start < end, f'Invalid RAM region: {line}'
+            yield Ram(start, end)
+        elif line.startswith('fill'):
+            d=line.rindex(")")
+            parts = line[5:d].split(',')
+            if parts[0].startswith('0x'):
+                parts[0] = parts[0][2:]
+            yield Data(hex_data('0x' + ''.join([parts[0]]*int(parts[1],0))))
+        elif line.startswith('backup is'):
+            self.backup = line[9:].strip()
+        elif line.startswith('src is'):
+            # the label of the program, `[` is allowed
+            self.src = line[6:].strip().strip('[]')
+        elif line.startswith(('loop580', 'loop880', 'backup580', 'backup880')):
+            ''' Built-in library entries. Syntax: `loop580(<remaining length>)`,
+            `loop880`, `backup580`, `backup880` '''
+            assert self.backup is not None and self.src is not None, \
+                '`backup is` and `src is` must be set first'
+            name, args = split_include(line)
+            if name == 'loop880':
+                args = ()  # the length is computed (remaining_length)
+            yield Link(self.library_object(name, args))
+        elif line.startswith('include'):
+            ''' Syntax: `include <name>` or `include <name>(<arg>, ...)`
+            Link the library entry `lib/<name>.asm`.
+            '''
+            yield Link(self.library_object(*split_include(line[7:])))
+        elif line.startswith('adr_arith'):
+            ''' Syntax: `adr_arith [offset] <label> - adr_arith [offset] <label>`
+            '''
+            last_minus_pos = len(line) - 1
+            while last_minus_pos > 0:
+                if line[last_minus_pos] == '-' and 'adr_arith' in line[last_minus_pos:]:
+                    break
+                last_minus_pos -= 1
         
-        if last_minus_pos <= 0:
-            raise ValueError(f'Invalid syntax for adr_arith: {line}')
+            if last_minus_pos <= 0:
+                raise ValueError(f'Invalid syntax for adr_arith: {line}')
             
-        left_part = line[9:last_minus_pos].strip()  
-        right_part = line[last_minus_pos + 1:].strip()
+            left_part = line[9:last_minus_pos].strip()  
+            right_part = line[last_minus_pos + 1:].strip()
         
-        def parse_adr_part(part):
-            part = part.strip()
-            if part.startswith('adr_arith'):
-                part = part[9:].strip()
+            def parse_adr_part(part):
+                part = part.strip()
+                if part.startswith('adr_arith'):
+                    part = part[9:].strip()
     
-            offset = 0
-            if '[' in part and ']' in part:
-                try:
-                    start_idx = part.index('[')
-                    end_idx = part.index(']')
-                    offset_str = part[start_idx+1:end_idx].strip()
+                offset = 0
+                if '[' in part and ']' in part:
                     try:
-                        offset = int(offset_str, 0)
-                    except ValueError:
-                        if offset_str.startswith('-'):
-                            offset = -int(offset_str[1:], 0)
-                        else:
-                            raise
+                        start_idx = part.index('[')
+                        end_idx = part.index(']')
+                        offset_str = part[start_idx+1:end_idx].strip()
+                        try:
+                            offset = int(offset_str, 0)
+                        except ValueError:
+                            if offset_str.startswith('-'):
+                                offset = -int(offset_str[1:], 0)
+                            else:
+                                raise
                             
-                    label = part[end_idx+1:].strip() 
-                    if not label:  
+                        label = part[end_idx+1:].strip() 
+                        if not label:  
+                            raise ValueError(f'Missing label in: {part}')
+                    except ValueError as e:
+                        if str(e).startswith('Missing'):
+                            raise e
+                        raise ValueError(f'Invalid offset in: {part}')
+                else:
+                    # Trường hợp không có offset
+                    label = part.strip()
+                    if not label:  # Label là bắt buộc
                         raise ValueError(f'Missing label in: {part}')
-                except ValueError as e:
-                    if str(e).startswith('Missing'):
-                        raise e
-                    raise ValueError(f'Invalid offset in: {part}')
-            else:
-                # Trường hợp không có offset
-                label = part.strip()
-                if not label:  # Label là bắt buộc
-                    raise ValueError(f'Missing label in: {part}')
     
-            return offset, label
+                return offset, label
     
-        # Parse both parts
-        left_offset, left_label = parse_adr_part(left_part)
-        right_offset, right_label = parse_adr_part(right_part)
+            # Parse both parts
+            left_offset, left_label = parse_adr_part(left_part)
+            right_offset, right_label = parse_adr_part(right_part)
     
-        # Store the deferred command
-        adr_arith_cmds.append((len(result), left_offset, left_label, right_offset, right_label))
-        result.append(0)  # Placeholder for the result
+            # Store the deferred command
+            yield AdrArith(left_offset, left_label, right_offset, right_label)
+
+        elif line.startswith('pr_length'):
+            ''' Syntax: `pr_length`
+            Defers the calculation of the program length until the end of processing.
+            '''
+            yield PrLength()
+        elif line.startswith('remaining_length'):
+            yield RemainingLength()
+        elif line.startswith('define_cmd'):
+            '''
+            define_cmd [old_gadget_name] [new_gadget_name]
+            Create alias for a gadget
+            '''
+            parts = re.findall(r'\[([^\]]+)\]', line)
+            assert len(parts) == 2, f'Invalid define_cmd syntax: {line}'
+            old_cmd, new_cmd = map(canonicalize, parts)
+            assert old_cmd in self.commands or old_cmd in self.datalabels, f'{old_cmd} not found in file gadget or label'
+            self.own_tables()
+            if old_cmd in self.commands:
+                address, tags = self.commands[old_cmd]
+                add_command(self.commands, address, new_cmd, tags, debug_info='alias command')
+            else:
+                address = self.datalabels[old_cmd]
+                self.datalabels[new_cmd] = address
+
+        elif line.startswith('define_gadget'):
+            '''
+            define_gadget [addr] [gadget_name]
+            Create a gadget_name from address
+            '''
+            parts = re.findall(r'\[([^\]]+)\]', line)
+            assert len(parts) == 2, f'Invalid define_gadget syntax: {line}'
+            addr_str, cmd = parts
+            cmd = canonicalize(cmd)
+            address = int(addr_str, 16)
+            self.own_tables()
+            add_command(self.commands, address, cmd, tags=('rt',), debug_info='manual gadget')
+
+
+        elif line.startswith('str'):
+            ''' Syntax:
+            - str <var> "<string>" :        store the hex value of the string into the variable <var> -> Define and store string in variable
+            - str <var>           :        Use(get value) of <var> [requires declaring string of var before calling] -> Use previously defined string variable
+            - str "<string>"       :        Get the hex value of a <string> directly (without using a variable, or reusing it) -> Direct string usage
+            + char "~" converted to space
+            + support for 580vnx
+            '''
+            content = line[3:].strip()
+
+            def string_to_bytes(text):
+                byte_list = []
+                #print("Processing string:", text)   # Debug print
+                for c in text:
+                    try:
+                        hex_val = char_to_hex[c]
+                        #print(f"Character '{c}' -> hex value: {hex_val}")  # Debug print
+                        if len(hex_val) == 2:
+                            byte_list.append(int(hex_val, 16))
+                        elif len(hex_val) == 4:
+                            byte_list.extend([int(hex_val[:2], 16), int(hex_val[2:], 16)])
+                    except KeyError:
+                        raise ValueError(f"Character '{c}' not found in conversion table")
+                #print("Final byte list:", byte_list)  # Debug print
+                return byte_list
+
+            if '"' in content:
+                quote_pos = content.find('"')
+                var_name = content[:quote_pos].strip() if quote_pos > 0 else None
+                text = content[quote_pos+1:].rstrip('"')
+
+                if var_name:
+                    self.string_vars = {**self.string_vars, var_name: text}
+                else:
+                    yield Print(f"Processing string: {text.replace('~', ' ')}")
+                    bytes_list = string_to_bytes(text)
+                    #print("Final bytes to add:", bytes_list)  # Debug print
+                    yield Data(bytes(bytes_list))
+
+            elif content:
+                self.reads_context = True
+                var_name = content.strip()
+                if var_name in self.string_vars:
+                    text = self.string_vars[var_name]
+                    yield Print(f"Processing string: {text.replace('~', ' ')}")
+                    bytes_list = string_to_bytes(text)
+                    #print("Final bytes to add:", bytes_list)  # Debug print
+                    yield Data(bytes(bytes_list))
+                else:
+                    raise ValueError(f"Undefined string variable: {var_name}")
+            else:
+                raise ValueError("Invalid str command syntax")
 
-    elif line.startswith('pr_length'):
-        ''' Syntax: `pr_length`
-        Defers the calculation of the program length until the end of processing.
-        '''
-        pr_length_cmds.append(len(result))
-        result.extend((0, 0))  # Placeholder for the length
-    elif line.startswith('remaining_length'):
-        endaddr = len(result)
-        end.append(len(result))
-        result.extend((0, 0))
-    elif line.startswith('define_cmd'):
-        '''
-        define_cmd [old_gadget_name] [new_gadget_name]
-        Create alias for a gadget
-        '''
-        parts = re.findall(r'\[([^\]]+)\]', line)
-        assert len(parts) == 2, f'Invalid define_cmd syntax: {line}'
-        old_cmd, new_cmd = map(canonicalize, parts)
-        assert old_cmd in commands or old_cmd in datalabels, f'{old_cmd} not found in file gadget or label'
-        if old_cmd in commands:
-            address, tags = commands[old_cmd]
-            add_command(commands, address, new_cmd, tags, debug_info='alias command')
         else:
-            address = datalabels[old_cmd]
-            datalabels[new_cmd] = address
+            assert False, f'Unrecognized command{self.model.names.did_you_mean(line)}'
 
-    elif line.startswith('define_gadget'):
-        '''
-        define_gadget [addr] [gadget_name]
-        Create a gadget_name from address
-        '''
-        parts = re.findall(r'\[([^\]]+)\]', line)
-        assert len(parts) == 2, f'Invalid define_gadget syntax: {line}'
-        addr_str, cmd = parts
-        cmd = canonicalize(cmd)
-        address = int(addr_str, 16)
-        add_command(commands, address, cmd, tags=('rt',), debug_info='manual gadget')
-
-
-    elif line.startswith('str'):
-        ''' Syntax:
-        - str <var> "<string>" :        store the hex value of the string into the variable <var> -> Define and store string in variable
-        - str <var>           :        Use(get value) of <var> [requires declaring string of var before calling] -> Use previously defined string variable
-        - str "<string>"       :        Get the hex value of a <string> directly (without using a variable, or reusing it) -> Direct string usage
-        + char "~" converted to space
-        + support for 580vnx
-        '''
-        content = line[3:].strip()
-
-        def string_to_bytes(text):
-            byte_list = []
-            print("Processing string:", text.replace('~', ' '))
-            #print("Processing string:", text)   # Debug print
-            for c in text:
-                try:
-                    hex_val = char_to_hex[c]
-                    #print(f"Character '{c}' -> hex value: {hex_val}")  # Debug print
-                    if len(hex_val) == 2:
-                        byte_list.append(int(hex_val, 16))
-                    elif len(hex_val) == 4:
-                        byte_list.extend([int(hex_val[:2], 16), int(hex_val[2:], 16)])
-                except KeyError:
-                    raise ValueError(f"Character '{c}' not found in conversion table")
-            #print("Final byte list:", byte_list)  # Debug print
-            return byte_list
-
-        if '"' in content:
-            quote_pos = content.find('"')
-            var_name = content[:quote_pos].strip() if quote_pos > 0 else None
-            text = content[quote_pos+1:].rstrip('"')
-
-            if var_name:
-                string_vars[var_name] = text
-            else:
-                bytes_list = string_to_bytes(text)
-                #print("Final bytes to add:", bytes_list)  # Debug print
-                result.extend(bytes_list)
-
-        elif content:
-            var_name = content.strip()
-            if var_name in string_vars:
-                text = string_vars[var_name]
-                bytes_list = string_to_bytes(text)
-                #print("Final bytes to add:", bytes_list)  # Debug print
-                result.extend(bytes_list)
-            else:
-                raise ValueError(f"Undefined string variable: {var_name}")
+    def add_source_map(self, lineno, start, end):
+        if self.source_map and self.source_map[-1][0] == lineno and self.source_map[-1][2] == start:
+            self.source_map[-1] = lineno, self.source_map[-1][1], end
         else:
-            raise ValueError("Invalid str command syntax")
+            self.source_map.append((lineno, start, end))
+
+    def parse_pop(self, line, register, value):
+        ''' `pop <register>(<value>)` and `<register> = <value>`. '''
+        yield from self.parse_call(f'pop {register}')
+        size = 0
+        for instr in self.parse(value.replace(',', ';')):
+            size += instr_size(instr)
+            yield instr
+        assert size == sizeof_register(register), \
+            f'Line {line!r} source/destination target mismatches'
 
-    else:
-        assert False, f'Unrecognized command'
-
-def finish_processing():
-    global result, labels, adr_arith_cmds, pr_length_cmds, addr
-
-    # Process deferred adr_arith commands
-    for pos, left_offset, left_label, right_offset, right_label in adr_arith_cmds:
-        if left_label in labels and right_label in labels:
-            left_adr = labels[left_label] + left_offset
-            right_adr = labels[right_label] + right_offset
-            result_adr = (left_adr - right_adr) & 0xFF
-            result[pos] = result_adr
+    def add_fixup(self, pos, instr):
+        ''' Record the relocation of the bytes at result[pos] for instr. '''
+        kind = type(instr)
+        if kind is AdrOf:
+            offset = instr.offset
+            if instr.base is not None:
+                offset += instr.base - self.home
+            reloc = Reloc(ABS16, pos, instr.label, offset, None, 0)
+        elif kind is AdrArith:
+            reloc = Reloc(DIFF8, pos, instr.left_label, instr.left_offset,
+                          instr.right_label, instr.right_offset)
+        elif kind is PrLength:
+            reloc = Reloc(LENGTH16, pos, None, 0, None, 0)
         else:
-            raise ValueError(f'Label not found: {left_label if left_label not in labels else right_label}')
-
-    # Process deferred pr_length commands
-    for pos in pr_length_cmds:
-        pr_length = len(result)
-        result[pos] = pr_length & 0xFF
-        result[pos + 1] = (pr_length >> 8) & 0xFF
-    addr = hx + len(result)
-    for pos in end:
-        remaining = len(result) - endaddr
-        result[pos] = remaining & 0xFF
-        result[pos +1] = (remaining >> 8) & 0xFF
-
-def process_program(args, program, overflow_initial_sp):
-    '''
-    Take a program (list of command lines) and print the compiled program
-    to the console.
-    '''
-    global result, labels, adr_of_cmds, adr_arith_cmds, pr_length_cmds, home, addr
-
-    # Read the entire program
-    modified_program = []
-    setup_loop_detected = False
-
-    for input_line in program:
-        line = canonicalize(del_inline_comment(input_line))
-        if line.startswith('setup_loop'):
-            setup_loop_detected = True
-            parts = line.split(',')
-            if len(parts) == 2:  # Chính xác 2 phần
-                src = parts[0].split()[1].strip()
-                src_backup = parts[1].strip()
-                label = 'home'  # Mặc định
-            elif len(parts) == 3:  # Chính xác 3 phần 
-                src = parts[0].split()[1].strip()
-                src_backup = parts[1].strip()
-                label = parts[2].strip() if parts[2].strip() != 'None' else 'home'
+            reloc = Reloc(REMAINING16, pos, None, 0, None, 0)
+        self.relocs.append(reloc)
+
+    def library_object(self, name, args):
+        ''' Return the Object of the library entry `name` with `args`,
+        compiled once per model. '''
+        params, lines = read_library_entry(name)
+        assert len(args) == len(params), \
+            f'{name} takes {len(params)} arguments ({", ".join(params)}), got {len(args)}'
+        values = dict(zip(params, args))
+        for param, value in ('backup', self.backup), ('src', self.src):
+            if value is not None:
+                values.setdefault(param, value)
+        key = name, tuple(sorted(values.items()))
+        obj = self.model.objects.get(key)
+        if obj is None:
+            try:
+                program = [line.format_map(values) for line in lines]
+            except KeyError as e:
+                raise ValueError(f'{name}: `{e.args[0]}` is not set') from None
+            obj = build_object(self.model, name, program)
+            self.model.objects.put(key, obj)
+        return obj
+
+    def emit(self, instr):
+        ''' Append the bytes of instr to the result. Label addresses are
+        zeroes until `link` fills them. '''
+        if self.deferred is not None:
+            self.deferred.append(instr)
+            return
+        kind = type(instr)
+        if kind is Data:
+            self.result.extend(instr.data)
+        elif kind is Call:
+            self.calls.append(len(self.result))
+            self.result.extend(instr.adr.to_bytes(4, 'little'))
+        elif kind is Label:
+            assert instr.name not in self.labels, f'Duplicated label: {instr.name}'
+            self.labels[instr.name] = len(self.result)
+            if self.sections:
+                self.label_sections[instr.name] = len(self.sections)
+        elif kind in _FIXUPS:
+            self.add_fixup(len(self.result), instr)
+            self.result.extend(bytes(_INSTR_SIZES[kind]))  # Placeholder
+        elif kind is Link:
+            obj = instr.obj
+            base = len(self.result)
+            for text in obj.notes:
+                self.note(text)
+            self.result.extend(obj.data)
+            for name, offset in obj.labels:
+                assert name not in self.labels, f'Duplicated label: {name}'
+                self.labels[name] = base + offset
+                if self.sections:
+                    self.label_sections[name] = len(self.sections)
+            for offset, fixup in obj.fixups:
+                self.add_fixup(base + offset, fixup)
+            self.calls.extend(base + offset for offset in obj.calls)
+        elif kind is Section:
+            assert all(instr.name != section.name for section, _, _ in self.sections), \
+                f'Duplicated section: {instr.name}'
+            self.sections.append([instr, len(self.result), None])
+        elif kind is Ram:
+            self.ram.append((instr.start, instr.end))
+        elif kind is Org:
+            assert not self.sections, '`org` in a section'
+            self.hx = instr.address
+            home1 = self.hx - len(self.result)
+            assert self.home is None or self.home == home1, 'Inconsistent value of `home`'
+            self.home = home1
+        elif kind is Note:
+            self.note(instr.text)
+        elif kind is Print:
+            if self.json_output:
+                # the output stream only has the JSON object
+                self.note(instr.text + '\n')
             else:
-                raise ValueError(f'Invalid setup_loop directive: {line} - Expected 2 or 3 parts')
-        
-            # Replace the setup_loop line with the provided code snippet
-            modified_code = f"""
-restore:
-    setlr
-    DI,RT
-    xr0 = adr_of length, 0x01, 0x00
-    [er0] = er2,rt
-    qr0 = pr_length, {src_backup}, {src}, 0x0000
-    0x8932
-length:
-    0x0800
-    0x0000
-set_sp:
-    er6 = adr_of [-2] {label}
-    sp = er6,pop er8
-"""
-            modified_program.extend(modified_code.strip().split('\n'))
+                print(instr.text, file=self.out)
         else:
-            modified_program.append(line)
+            assert False, 'Internal error'
+    def finish_processing(self):
+        ''' Check that the relocations only use known labels. '''
+        for reloc in self.relocs:
+            for label in reloc.label, reloc.right_label:
+                if label is not None and label not in self.labels:
+                    raise ValueError(f'Label not found: {label}{NameIndex(self.labels).did_you_mean(label)}')
+
+    def main_length(self):
+        ''' Return the number of bytes placed at `home`. '''
+        return self.sections[0][1] if self.sections else len(self.result)
+
+    def label_address(self, label):
+        ''' Return the address of label, `home` and the sections being placed. '''
+        k = self.label_sections.get(label, 0)
+        if k == 0:
+            return self.home + self.labels[label]
+        _, start, address = self.sections[k - 1]
+        return address + self.labels[label] - start
+
+    def adr_of_targets(self, k=0):
+        ''' Return the offsets from its start of the ABS16 relocation targets
+        in the part k (0: the bytes at `home`, else sections[k - 1]). '''
+        labels, label_sections = self.labels, self.label_sections
+        start = self.sections[k - 1][1] if k else 0
+        return [labels[reloc.label] - start + reloc.offset for reloc in self.relocs
+                if reloc.kind is ABS16 and label_sections.get(reloc.label, 0) == k]
+
+    def layout(self, ram_regions, overflow_initial_sp):
+        ''' Place the sections in the `ram` regions of the program, else in
+        ram_regions (see `place_sections`), out of the bytes at `home` and
+        of the stack below them: from STACK_MARGIN bytes under home or the
+        initial SP, whichever is lower. '''
+        low = min(self.home, overflow_initial_sp) - STACK_MARGIN
+        end = self.home + self.main_length()
+        free = [gap for start, stop in (self.ram or ram_regions)
+                for gap in ((start, min(stop, low)), (max(start, end), stop))
+                if gap[0] < gap[1]]
+        starts = [start for _, start, _ in self.sections]
+        lengths = [stop - start for start, stop in zip(starts, starts[1:] + [len(self.result)])]
+        requests = [(section.name, max(section.size, length), section.align, self.adr_of_targets(k))
+                    for k, ((section, _, _), length) in enumerate(zip(self.sections, lengths), 1)]
+        addresses, self.free_ram = place_sections(self.model, free, requests)
+        for entry in self.sections:
+            entry[2] = addresses[entry[0].name]
+
+    def parts(self):
+        ''' Yield (name, address, end address, bytes) of the bytes at `home`,
+        then of every section. '''
+        starts = [start for _, start, _ in self.sections]
+        yield None, self.home, self.addr, self.result[:self.main_length()]
+        for (section, start, address), stop in zip(self.sections, starts[1:] + [len(self.result)]):
+            yield section.name, address, address + stop - start, self.result[start:stop]
+
+    def link(self, length):
+        ''' Write the values of all relocations into result, `home` and the
+        sections being placed. length is the length of the program. '''
+        result, address = self.result, self.label_address
+        starts = [0] + [start for _, start, _ in self.sections]
+        ends = starts[1:] + [length]
+        pack_into = struct.pack_into
+        for kind, pos, label, offset, right_label, right_offset in self.relocs:
+            if kind is ABS16:
+                pack_into('<H', result, pos, (address(label) + offset) & 0xFFFF)
+            elif kind is DIFF8:
+                result[pos] = (address(label) + offset - address(right_label) - right_offset) & 0xFF
+            else:
+                # the length of the section of pos, or what is left of it
+                k = bisect_right(starts, pos) - 1
+                value = ends[k] - (starts[k] if kind is LENGTH16 else pos)
+                pack_into('<H', result, pos, value & 0xFFFF)
+
+    def plan_calls(self, start=0):
+        ''' Change the addresses of the calls from self.calls[start] on to
+        the ones running the same code with the fewest key strokes, see
+        Model.call_for_npress. '''
+        model, result = self.model, self.result
+        for pos in self.calls[start:]:
+            adr = int.from_bytes(result[pos:pos + 3], 'little')
+            best = model.call_for_npress(adr)
+            if best != adr:
+                result[pos:pos + 3] = best.to_bytes(3, 'little')
+                self.planned_calls += 1
+                self.planned_npress += model.call_npress(adr) - model.call_npress(best)
+
+    def key_npress(self):
+        ''' Return the key strokes of the result as (total, calls, label
+        values), after `link`. '''
+        get_npress, result = self.model.get_npress, self.result
+        calls = sum(get_npress(result[pos:pos + 4]) for pos in self.calls)
+        labels = sum(get_npress(result[reloc.pos:reloc.pos + _RELOC_SIZES[reloc.kind]])
+                     for reloc in self.relocs)
+        return get_npress(result), calls, labels
+
+    def optimize(self, statements, parse_cache=None):
+        ''' Parse all statements, then shrink their instructions with
+        `peephole`. Return a list of (line number, statement, instructions). '''
+        parsed = []
+        try:
+            for lineno, line in statements:
+                self.deferred = []
+                try:
+                    if parse_cache is None:
+                        self.process(line)
+                    else:
+                        parse_cache.process(self, line)
+                except:
+                    self.note(f'While processing line\n{line}\n')
+                    raise
+                parsed.append((lineno, line, self.deferred))
+        finally:
+            self.deferred = None
+
+        code = [(i, instr) for i, (_, _, instrs) in enumerate(parsed) for instr in instrs]
+        code, self.saved = peephole(code, self.commands, self.model.optimize_adr_for_npress)
+        instrs = [[] for _ in parsed]
+        for i, instr in code:
+            instrs[i].append(instr)
+        return [(lineno, line, instrs[i]) for i, (lineno, line, _) in enumerate(parsed)]
+
+    def process_program(self, args, program, overflow_initial_sp, home_step=100,
+                        parse_cache=None, ram_regions=()):
+        '''
+        Take a program (list of command lines) and print the compiled program
+        to the output stream.
 
-    # If setup_loop was not detected, use the original program
-    if not setup_loop_detected:
-        modified_program = program
+        Without `org`, `home` is searched in steps of `home_step` bytes from
+        `overflow_initial_sp`.
 
-    # Process the modified program
-    for line in modified_program:
-        line = canonicalize(del_inline_comment(line))
+        With a ParseCache, the statements already parsed by the previous
+        compile of the cache (in the same parser state) are not parsed again.
 
-        # Chỉ sử dụng to_lowercase nếu dòng không bắt đầu bằng "str"
-        if not line.lower().startswith("str"):
-            line = to_lowercase(line)
+        With `args.optimize`, the whole program is parsed before anything is
+        emitted, for `peephole` to shrink it.
 
-        # temporarily redirect notes to note_log
-        note_log = ''
-        global note
-        note_ = note
+        The sections are placed in ram_regions, a list of (start, end), unless
+        the program gives its own with `ram`.
+        '''
 
-        def note(st):
-            nonlocal note_log
-            note_log += st
+        self.json_output = args.format == 'json'
+        if parse_cache is None:
+            statements = lex_program(program)
+        else:
+            parse_cache.start()
+            statements = lex_program(program, parse_cache.lex)
+        if args.optimize:
+            statements = self.optimize(statements, parse_cache)
+        else:
+            statements = ((lineno, line, None) for lineno, line in statements)
+        for lineno, line, instrs in statements:
+            # temporarily redirect notes to note_log
+            self.note_log = []
+
+            old_len_result = len(self.result)
+            old_len_calls = len(self.calls)
+            try:
+                if instrs is not None:
+                    for instr in instrs:
+                        self.emit(instr)
+                elif parse_cache is None:
+                    self.process(line)
+                else:
+                    parse_cache.process(self, line)
+            except:
+                self.note_log = None
+                self.note(f'While processing line\n{line}\n')
+                raise
+            finally:
+                if len(self.result) > old_len_result:
+                    self.add_source_map(lineno, old_len_result, len(self.result))
+
+            if args.format == 'key':
+                self.plan_calls(old_len_calls)
+            # labels have undetermined value and they are temporarily represented
+            # by zeroes in result list
+            if args.format == 'key' and \
+                    any(x != 0 and self.model.get_npress(x) > 100 for x in self.result[old_len_result:]):
+                self.note('Line generates many keypresses\n')
+
+            # restore warnings
+            note_log, self.note_log = self.note_log, None
+            if note_log and args.format == 'json':
+                self.line_notes.append([lineno, ''.join(note_log)])
+            elif note_log:
+                self.note(f'While processing line\n{line}\n')
+                self.note(''.join(note_log))
+
+        if parse_cache is not None:
+            parse_cache.finish()
+        if args.format == 'json':
+            # the notes from now on are warnings about the whole program
+            self.note_log = self.warnings
+
+        self.finish_processing()
+        length = len(self.result)
+        assert not self.sections or args.target == 'none', 'Sections need target none'
+
+        if args.target in ('none', 'overflow'):
+            if args.target == 'overflow':
+                assert len(self.result) <= 100, 'Program too long'
+
+            if self.home is None:  # `org` is not used
+                # compute value of `home`
+                self.home = overflow_initial_sp
+                if 'home' in self.labels:
+                    self.home -= self.labels['home']  # so that the SP starts at the `home:` label
+                if self.home + len(self.result) > 0x8E00:
+                    self.note(f'Warning: Program length after home = {len(self.result)} bytes'
+                              f' > {0x8E00 - self.home} bytes\n')
+
+                min_home = self.home
+                while min_home >= 0x8154 + 200:
+                    min_home -= home_step
+                while self.home + len(self.result) <= 0x8E00:
+                    self.home += home_step  # 0x8E00: end of RAM
+                # fewest `adr_of` targets with many keypresses, if ties then take max `home`
+                self.home = self.model.pick_home(
+                    range(min_home, self.home, home_step), self.adr_of_targets())
+
+        elif args.target == 'loader':
+            if self.home is None:
+                self.home = 0x85b0 - len(self.result)
+                entry = self.home + self.labels.get('home', 0) - 2
+                self.result.extend((0x6a, 0x4f, 0, 0, entry & 255, entry >> 8, 0x68, 0x4f, 0, 0))
+                while self.home + len(self.result) < 0x85d7:
+                    self.result.append(0)
+                self.result.extend((0xff, 0xae, 0x85))
+                home2 = 0
+                assert (self.home - home2) >= 0x8501, 'Program too long'
+                while self.model.get_npress_adr(self.home - home2) >= 100:
+                    home2 += 1
 
-        old_len_result = len(result)
-        try:
-            process(line)
-        except:
-            note_(f'While processing line\n{line}\n')
-            raise
-
-        # labels have undetermined value and they are temporarily represented
-        # by zeroes in result list
-        if args.format == 'key' and \
-                any(x != 0 and get_npress(x) > 100 for x in result[old_len_result:]):
-            note('Line generates many keypresses\n')
-
-        # restore warnings
-        note = note_
-        if note_log:
-            note(f'While processing line\n{line}\n')
-            note(note_log)
-
-    # Process deferred adr_arith and pr_length commands
-    finish_processing()
-
-    # A list of (source adr, offset relative to `home`).
-    adr_of_cmds = [(source_adr, labels[target_label] + offset)
-                   for source_adr, offset, target_label in adr_of_cmds]
-
-    if args.target in ('none', 'overflow'):
+        else:
+            assert False, 'Internal error'
+
+        # home is picked now, now substitute in the result
+        assert self.home is not None
+        self.addr = self.home + self.main_length()
+        if self.sections:
+            self.layout(ram_regions, overflow_initial_sp)
+        self.link(length)
+
+        self.note_log = None
+        if args.target == 'none' and args.format == 'json':
+            json.dump(self.summary(), self.out, separators=(',', ':'))
+            self.out.write('\n')
+            return
+
+        Fore = self.colors
+        # debug print label location
+        for label in self.labels:
+            self.note(Fore.GREEN + f'Label {label} is at address 0x{self.label_address(label):04X}\n')
+        print(Fore.CYAN + f'Program length (hex): {self.main_length():04X} bytes', file=self.out)
+        print(Fore.CYAN + f'Program length (dec): {self.main_length()} bytes\n', file=self.out)
+        if self.sections:
+            for name, address, end, data in list(self.parts())[1:]:
+                print(Fore.CYAN + f'Section {name} is at 0x{address:04X}: {len(data)} bytes', file=self.out)
+            free = [end - start for start, end in self.free_ram]
+            if free:
+                print(Fore.CYAN + f'Free RAM: {sum(free)} bytes in {len(free)} region{"s" * (len(free) > 1)}, the largest is'
+                      f' {max(free)} bytes ({1 - max(free) / sum(free):.0%} fragmentation)\n', file=self.out)
+            else:
+                print(Fore.CYAN + 'Free RAM: 0 bytes\n', file=self.out)
+        if args.optimize:
+            print(Fore.CYAN + f'Optimizer saved {self.saved} bytes\n', file=self.out)
+        if args.format == 'key':
+            total, calls, labels = self.key_npress()
+            print(Fore.CYAN + f'Keypresses: {total} (calls {calls}, label values {labels},'
+                  f' other data {total - calls - labels})', file=self.out)
+            print(Fore.CYAN + f'Equivalent gadget addresses saved {self.planned_npress}'
+                  f' keypresses on {self.planned_calls} calls\n', file=self.out)
         if args.target == 'overflow':
-            assert len(result) <= 100, 'Program too long'
-
-        if home is None:  # `org` is not used
-            # compute value of `home`
-            home = overflow_initial_sp
-            if 'home' in labels:
-                home -= labels['home']  # so that the SP starts at the `home:` label
-            if home + len(result) > 0x8E00:
-                note(f'Warning: Program length after home = {len(result)} bytes'
-                     f' > {0x8E00 - home} bytes\n')
-
-            min_home = home
-            while min_home >= 0x8154 + 200:
-                min_home -= 100
-            while home + len(result) <= 0x8E00:
-                home += 100  # 0x8E00: end of RAM
-            home = min(range(min_home, home, 100), key=lambda home:
-                        (
-                            sum(  # count number of ... satisfy condition
-                                get_npress_adr(home + home_offset) >= 100
-                                for source_adr, home_offset in adr_of_cmds),
-                            -home  # if ties then take max `home`
-                        )
-                        )
-
-    elif args.target == 'loader':
-        if home is None:
-            home = 0x85b0 - len(result)
-            entry = home + labels.get('home', 0) - 2
-            result.extend((0x6a, 0x4f, 0, 0, entry & 255, entry >> 8, 0x68, 0x4f, 0, 0))
-            while home + len(result) < 0x85d7:
-                result.append(0)
-            result.extend((0xff, 0xae, 0x85))
-            home2 = 0
-            assert (home - home2) >= 0x8501, 'Program too long'
-            while get_npress_adr(home - home2) >= 100:
-                home2 += 1
+            # scroll it around (use the most inefficient way)
+            hackstring = list(map(ord, '1234567890' * 10))  # but still O(n)
+            for home_offset, byte in enumerate(self.result):
+                assert isinstance(byte, int), (home_offset, byte)
+                hackstring[(self.home + home_offset - 0x8154) % 100] = byte
+
+        # done
+        if args.target == 'overflow' and args.format == 'hex':
+            print(''.join(f'{byte:0{2}x}' for byte in hackstring), file=self.out)
+        elif args.target == 'none' and args.format == 'hex':
+            for name, address, end, data in self.parts():
+                # one string: the output stream may be slow per write
+                print(' '.join([Fore.WHITE + f'===0x%04X -> {hex(end).upper()}===\n' % address + Fore.RED,
+                                *filter(None, [data.hex(' ').upper()])]), file=self.out)
+                print(Fore.WHITE + f'======================', file=self.out)
+        elif args.target == 'none' and args.format == 'key':
+            for name, address, end, data in self.parts():
+                print(f'{address:#06x}:', ' '.join(
+                    self.model.byte_to_key(byte) for byte in data
+                ), file=self.out)
+        elif args.target == 'loader' and args.format == 'key':
+            # NOTE: loader target may be specific to 570es+/991es+
+            print('Address to load: %s %s' % (self.model.byte_to_key((self.home - home2) & 255), self.model.byte_to_key((self.home - home2) >> 8)), file=self.out)
+            for i in range(home2):
+                self.result.insert(0, 0)
+            import keypairs
+            print(keypairs.format(self.result), file=self.out)
+        elif args.target == 'overflow' and args.format == 'key':
+            print(' '.join(self.model.byte_to_key(x) for x in hackstring), file=self.out)
+        else:
+            raise ValueError('Unsupported target/format combination')
+
+    def summary(self):
+        ''' Return the compiled program as a dict for `json.dump`. '''
+        parts = list(self.parts())
+        return {
+            'home': self.home,
+            'org': self.hx,
+            'end': self.addr,
+            'length': len(parts[0][3]),
+            'saved': self.saved,
+            'data': parts[0][3].hex(),
+            'sections': [{'name': name, 'address': address, 'length': len(data),
+                          'size': section.size, 'data': data.hex()}
+                         for (name, address, end, data), (section, _, _) in zip(parts[1:], self.sections)],
+            'free': self.free_ram,
+            'labels': {label: self.label_address(label) for label in self.labels},
+            'warnings': self.warnings,
+            'notes': self.line_notes,
+        }
+
+class ParseCache:
+    '''
+    The instructions of the statements of the last compiled version of a
+    program, for an editor compiling the program again after every edit.
 
-    else:
-        assert False, 'Internal error'
-
-    # home is picked now, now substitute in the result
-    assert home is not None
-    for source_adr, home_offset in adr_of_cmds:
-        target_adr = home + home_offset
-        assert result[source_adr] == 0
-        result[source_adr] = target_adr & 0xFF
-        assert result[source_adr + 1] == 0
-        result[source_adr + 1] = target_adr >> 8
-
-    # debug print label location
-    for label, home_offset in labels.items():
-        note(Fore.GREEN + f'Label {label} is at address 0x{home + home_offset:04X}\n')
-    print(Fore.CYAN + f'Program length (hex): {len(result):04X} bytes')
-    print(Fore.CYAN + f'Program length (dec): {len(result)} bytes\n')
-    if args.target == 'overflow':
-        # scroll it around (use the most inefficient way)
-        hackstring = list(map(ord, '1234567890' * 10))  # but still O(n)
-        for home_offset, byte in enumerate(result):
-            assert isinstance(byte, int), (home_offset, byte)
-            hackstring[(home + home_offset - 0x8154) % 100] = byte
-
-    # done
-    if args.target == 'overflow' and args.format == 'hex':
-        print(''.join(f'{byte:0{2}x}' for byte in hackstring))
-    elif args.target == 'none' and args.format == 'hex':
-        print(Fore.WHITE + f'===0x%04X -> {hex(addr).upper()}===\n' % home +Fore.RED, *map('%02X'.__mod__, result))
-        print(Fore.WHITE + f'======================')
-    elif args.target == 'none' and args.format == 'key':
-        print(f'{home:#06x}:', ' '.join(
-            byte_to_key(byte) for byte in result
-        ))
-    elif args.target == 'loader' and args.format == 'key':
-        # NOTE: loader target may be specific to 570es+/991es+
-        print('Address to load: %s %s' % (byte_to_key((home - home2) & 255), byte_to_key((home - home2) >> 8)))
-        for i in range(home2):
-            result.insert(0, 0)
-        import keypairs
-        print(keypairs.format(result))
-    elif args.target == 'overflow' and args.format == 'key':
-        print(' '.join(byte_to_key(x) for x in hackstring))
-    else:
-        raise ValueError('Unsupported target/format combination')
+    A statement is parsed again only if it is new or if the parser state
+    it starts in changed (after a `/*`, `str <var> "..."`, `define_cmd`,
+    `backup is`, ...). Statements evaluating Python (`$`) are always parsed
+    again. The bytes are emitted again from the instructions and the labels
+    resolved as usual, both being cheap.
+
+    Use one cache per program being edited, from one thread at a time
+    (see `lock`).
+    '''
+
+    def __init__(self):
+        self.entries = {}  # statement -> list of (state before, instructions, state after)
+        self.used = None  # entries of the compile in progress
+        self.lexed = {}  # command line -> statements
+        self.used_lexed = {}
+        self.lock = threading.Lock()
+        self.reused = self.parsed = 0
+
+    def start(self):
+        if self.used is not None:
+            # the last compile stopped at an error, keep what it parsed too
+            for line, entries in self.used.items():
+                old = self.entries.setdefault(line, [])
+                old.extend(entry for entry in entries if not any(entry is e for e in old))
+            self.lexed.update(self.used_lexed)
+        self.used = {}
+        self.used_lexed = {}
+        self.reused = self.parsed = 0
+
+    def finish(self):
+        self.entries, self.used = self.used, None
+        self.lexed = self.used_lexed
+
+    def lex(self, input_line):
+        ''' Like lex_line(input_line). '''
+        statements = self.lexed.get(input_line)
+        if statements is None:
+            statements = lex_line(input_line)
+        self.used_lexed[input_line] = statements
+        return statements
+
+    def process(self, session, line):
+        ''' Like session.process(line). '''
+        state = session.parse_state()
+        for entry in self.entries.get(line, ()):
+            if entry[0] == state:
+                for instr in entry[1]:
+                    session.emit(instr)
+                session.set_parse_state(entry[2])
+                self.reused += 1
+                break
+        else:
+            entry = state, session.process(line), session.parse_state()
+            self.parsed += 1
+            if '$' in line:
+                return
+        used = self.used.setdefault(line, [])
+        if not any(entry is e for e in used):
+            used.append(entry)
+
+def build_object(model, name, program):
+    ''' Compile a library entry (list of command lines) into an Object. The
+    entry only sees the gadgets of the model, not the `define_cmd` of the
+    program including it. '''
+    session = CompilerSession(model)
+    data = bytearray()
+    labels, fixups, notes, calls = [], [], [], []
+    for lineno, line in lex_program(program):
+        for instr in session.parse(line):
+            kind = type(instr)
+            if kind is Data:
+                data += instr.data
+            elif kind is Call:
+                calls.append(len(data))
+                data += instr.adr.to_bytes(4, 'little')
+            elif kind is Label:
+                labels.append((instr.name, len(data)))
+            elif kind in _FIXUPS:
+                fixups.append((len(data), instr))
+                data += bytes(_INSTR_SIZES[kind])
+            elif kind is Link:
+                obj = instr.obj
+                labels.extend((label, len(data) + offset) for label, offset in obj.labels)
+                fixups.extend((len(data) + offset, fixup) for offset, fixup in obj.fixups)
+                notes.extend(obj.notes)
+                calls.extend(len(data) + offset for offset in obj.calls)
+                data += obj.data
+            elif kind is Note:
+                notes.append(instr.text)
+            else:
+                # `org`, `section`, `ram`, the output of `str`, ...
+                raise ValueError(f'`{kind.__name__.lower()}` is not supported in library entry '
+                                 f'{name}: {line}')
+    return Object(name, bytes(data), tuple(labels), tuple(fixups), tuple(notes), tuple(calls))
+
+_REGISTER_PREFIX = {1: 'r', 2: 'er', 4: 'xr', 8: 'qr'}
+
+def register_bytes(reg):
+    ''' Return the range of r0..r15 that reg is made of, or None if reg
+    is not r<n>, er<n>, xr<n> or qr<n>. '''
+    match = re.fullmatch(r'(r|er|xr|qr)(\d+)', reg)
+    if match is None:
+        return None
+    size, n = sizeof_register(reg), int(match[2])
+    if n % size or n + size > 16:
+        return None
+    return range(n, n + size)
+
+def gadget_shape(name):
+    ''' Split a gadget name into (operations, popped registers, rt), e.g.
+    `r0=r5,pop er4,rt` into (('r0=r5',), ['er4'], True). Return None if
+    what the gadget takes from the stack is not only its trailing pops. '''
+    if name is None:
+        return None
+    parts = name.split(',')
+    rt = parts[-1] == 'rt'
+    if rt:
+        parts.pop()
+    pops = []
+    while parts and parts[-1].startswith('pop ') and register_bytes(parts[-1][4:]):
+        pops.insert(0, parts.pop()[4:])
+    if any('pop' in part or 'sp' in part or part == 'rt' for part in parts):
+        return None
+    return tuple(parts), pops, rt
+
+def gadget_name(operations, pops, rt):
+    return ','.join([*operations, *('pop ' + reg for reg in pops), *['rt'] * rt])
+
+_OPERANDS = Data, AdrOf, AdrArith, PrLength, RemainingLength
+
+def peephole(code, commands, optimize_adr):
+    '''
+    Shrink a ROP chain. code is a list of (key, instruction); the keys
+    are kept, so the caller can tell which statement each instruction
+    comes from. Return (the new code, number of bytes saved).
+
+    A gadget is a `call` and the operands after it (the values it pops).
+    Only gadgets next to each other, whose names tell what they pop and
+    whose operands fit that, are changed:
+    - a trailing pop overwritten by the next gadget, a pure pop, is
+      dropped with its value if the gadget without it exists;
+    - two pure pops are merged into one gadget that pops both
+      (`pop er0` + `pop er2` -> `pop xr0`) if it exists;
+    - a `setlr` is dropped if the last one is still in effect, only
+      pure pops being called since.
+    '''
+    # units: [call entry or None, entries]
+    units = []
+    for entry in code:
+        if type(entry[1]) is Call:
+            units.append([entry, []])
+        elif type(entry[1]) in _OPERANDS and units and units[-1][0] is not None:
+            units[-1][1].append(entry)
+        else:
+            units.append([None, [entry]])
+
+    def shape(unit):
+        ''' Return the gadget_shape of unit if its operands fit it. '''
+        if unit[0] is None:
+            return None
+        shape = gadget_shape(unit[0][1].name)
+        if shape is None or sum(map(sizeof_register, shape[1])) != \
+                sum(instr_size(instr) for _, instr in unit[1]):
+            return None
+        return shape
+
+    def call(key, name):
+        ''' Return the entry calling gadget name, or None if it does not exist
+        or has warnings. '''
+        if name not in commands or commands[name][1]:
+            return None
+        return key, Call(optimize_adr(commands[name][0]), name)
+
+    def drop_operand_bytes(entries, n):
+        ''' Drop the last n bytes of entries if they are plain data. '''
+        entries = list(entries)
+        while n:
+            key, instr = entries.pop()
+            if type(instr) is not Data:
+                return None
+            if len(instr.data) > n:
+                entries.append((key, Data(instr.data[:-n])))
+                break
+            n -= len(instr.data)
+        return entries
+
+    before = sum(instr_size(instr) for _, instr in code)
+
+    # dead trailing pops
+    i = 0
+    while i < len(units) - 1:
+        this, next_ = shape(units[i]), shape(units[i + 1])
+        if not (this and this[1] and next_ and not next_[0]):
+            i += 1
+            continue
+        operations, pops, rt = this
+        overwritten = set().union(*map(register_bytes, next_[1]))
+        if not overwritten.issuperset(register_bytes(pops[-1])):
+            i += 1
+            continue
+        entries = drop_operand_bytes(units[i][1], sizeof_register(pops[-1]))
+        if entries is None:
+            i += 1
+            continue
+        if not operations and len(pops) == 1 and not rt:
+            del units[i]  # a pure pop with nothing left to pop
+            i = max(i - 1, 0)
+            continue
+        entry = call(units[i][0][0], gadget_name(operations, pops[:-1], rt))
+        if entry is None:
+            i += 1
+            continue
+        units[i] = [entry, entries]
+
+    # merge pure pops
+    i = 0
+    while i < len(units) - 1:
+        this, next_ = shape(units[i]), shape(units[i + 1])
+        if not (this and next_ and not this[0] and not this[2] and not next_[0]):
+            i += 1
+            continue
+        names = [gadget_name((), this[1] + next_[1], next_[2])]
+        if len(this[1]) == len(next_[1]) == 1:
+            size = sizeof_register(this[1][0])
+            low, high = register_bytes(this[1][0]), register_bytes(next_[1][0])
+            if (size < 8 and sizeof_register(next_[1][0]) == size
+                    and high.start == low.stop and low.start % (2 * size) == 0):
+                names.append(gadget_name((), [f'{_REGISTER_PREFIX[2 * size]}{low.start}'], next_[2]))
+        for name in names:
+            entry = call(units[i][0][0], name)
+            if entry is not None:
+                units[i: i + 2] = [[entry, units[i][1] + units[i + 1][1]]]
+                break
+        else:
+            i += 1
+
+    # setlr still in effect
+    lr_set = False
+    i = 0
+    while i < len(units):
+        this = shape(units[i])
+        if this == (('setlr',), [], False):
+            if lr_set:
+                del units[i]
+                continue
+            lr_set = True
+        elif not (this and not this[0]):
+            lr_set = False
+        i += 1
+
+    code = []
+    for entry, entries in units:
+        if entry is not None:
+            code.append(entry)
+        code.extend(entries)
+    return code, before - sum(instr_size(instr) for _, instr in code)
+
+def place_sections(model, free, sections):
+    '''
+    Place sections, a list of (name, size, align, offsets), in free, a list
+    of (start, end) free RAM regions. Return ({name: address}, the free
+    regions left).
+
+    The largest sections are placed first, each where the fewest of its
+    `adr_of` targets (address + offset for offset in offsets) take 100 key
+    strokes or more, then where they take the fewest key strokes. In a
+    region, `Model.pick_home` takes the highest address, so the region
+    left is in one piece.
+    '''
+    free = sorted(free)
+    addresses = {}
+    for name, size, align, offsets in sorted(sections, key=lambda section: -section[1]):
+        best = None
+        for k, (start, end) in enumerate(free):
+            first = -(-start // align) * align
+            if first + size > end:
+                continue
+            address = model.pick_home(range(first, end - size + 1, align), offsets)
+            targets = [address + offset for offset in offsets]
+            cost = (sum(model.get_npress_adr(target) >= 100 for target in targets),
+                    model.get_npress_adr(targets))
+            if best is None or cost < best[0]:
+                best = cost, address, k
+        if best is None:
+            largest = max((end - start for start, end in free), default=0)
+            raise ValueError(f'No room in RAM for section {name} ({size} bytes), '
+                             f'the largest free region is {largest} bytes; '
+                             f'give the RAM to use with `ram <start>, <end>`')
+        _, address, k = best
+        start, end = free[k]
+        free[k:k + 1] = [gap for gap in ((start, address), (address + size, end)) if gap[0] < gap[1]]
+        addresses[name] = address
+    return addresses, free
+
+def process_program(args, program, overflow_initial_sp, home_step=100, ram_regions=()):
+    '''
+    Take a program (list of command lines) and print the compiled program
+    to the console.
+    '''
+    session = CompilerSession(Model.current(), colors=terminal_colors())
+    session.process_program(args, program, overflow_initial_sp, home_step,
+                            ram_regions=ram_regions)
 
 rom = None
 
@@ -918,50 +1895,13 @@ def get_rom(x):
 
 def find_equivalent_addresses(rom: bytes, q: set):
     # handles BL / POP PC, BC AL, B
-    from collections import defaultdict
-    comefrom = defaultdict(list)  # adr -> list of comefrom addresses
-
-    for i in range(0, len(rom), 2):  # BC AL
-        if rom[i + 1] == 0xce:
-            offset = rom[i]
-            if offset >= 128:
-                offset -= 256
-            comefrom[i >> 16 | ((i + (offset + 1) * 2) & 0xffff)].append(i)
-
-    for i in range(0, len(rom) - 2, 2):  # B
-        if (
-                rom[i] == 0x00 and
-                (rom[i + 1] & 0xf0) == 0xf0):
-            comefrom[(rom[i + 1] & 0x0f) << 16 | rom[i + 3] << 8 | rom[i + 2]].append(i)
-
-    for i in range(0, len(rom) - 4, 2):  # BL / POP PC
-        if (
-                rom[i] == 0x01 and
-                (rom[i + 1] & 0xf0) == 0xf0 and
-                (rom[i + 4] & 0xf0) == 0x8e and
-                (rom[i + 5] & 0xf0) == 0xf2):
-            comefrom[(rom[i + 1] & 0x0f) << 16 | rom[i + 3] << 8 | rom[i + 2]].append(i)
-
-    ans = set()
-    while q:
-        adr = q.pop()
-        if adr in ans:
-            continue
-        ans.add(adr)
-
-        if adr in comefrom:
-            q.update(comefrom[adr])
-
-    return ans
+    # the come-from graph is built once per ROM, see romindex.py
+    return get_xref_index(rom).closure(q)
 
 def optimize_gadget_f(rom: bytes, gadget: bytes) -> set:
     assert len(gadget) % 2 == 0
-    q = set()  # pending addresses
-
     # find occurrences of gadget in rom
-    for i in range(0, len(rom) - len(gadget) + 1, 2):
-        if rom[i:i + len(gadget)] == gadget:
-            q.add(i)
+    q = set(get_word_index(rom).find(gadget))  # pending addresses
 
     return find_equivalent_addresses(rom, q)
 
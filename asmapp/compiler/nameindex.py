@@ -0,0 +1,103 @@
+'''Trigram index of names, for "did you mean" and completion.
+
+A name is split into the trigrams of `  name ` (two spaces in front, one
+after), so that short names and their first letters have trigrams too.
+The names sharing the most trigrams with an unknown name are ranked by
+edit distance; only those are compared, not the whole table. An edit
+changes at most 3 trigrams, so a name at distance d shares all but 3 * d
+trigrams of the other one at least, and the others are not compared.
+
+Completion of a prefix is a binary search in the sorted names.
+'''
+from bisect import bisect_left
+from collections import Counter
+
+# names sharing the most trigrams that are ranked by edit distance
+CANDIDATES = 32
+
+
+def trigrams(name):
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    ''' Return the Levenshtein distance of a and b, or limit + 1 if it is
+    more than limit. Only the cells within limit of the diagonal are
+    computed. '''
+    far = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return far
+    row = [min(j, far) for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        low, high = max(1, i - limit), min(len(b), i + limit)
+        new = [far] * (len(b) + 1)
+        new[0] = min(i, far)
+        closest = new[0]
+        for j in range(low, high + 1):
+            cost = row[j - 1] + (ca != b[j - 1])
+            if row[j] + 1 < cost:
+                cost = row[j] + 1
+            if new[j - 1] + 1 < cost:
+                cost = new[j - 1] + 1
+            new[j] = cost
+            if cost < closest:
+                closest = cost
+        if closest > limit:
+            return far
+        row = new
+    return min(row[-1], far)
+
+
+class NameIndex:
+    ''' The names of a table by trigram. '''
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self.postings = {}  # trigram -> indexes in names
+        for i, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.postings.setdefault(gram, []).append(i)
+
+    def suggest(self, name, limit=3):
+        ''' Return up to limit known names close to name, the closest first. '''
+        grams = trigrams(name)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        max_distance = max(2, len(name) // 3)
+        ranked = []
+        # ties by position in names: the order of shared depends on the hash seed
+        candidates = sorted(shared.items(), key=lambda item: (-item[1], item[0]))
+        for i, count in candidates[:CANDIDATES]:
+            # the fewer trigrams shared, the farther the names
+            if (len(grams) - count + 2) // 3 > max_distance:
+                break
+            candidate = self.names[i]
+            distance = edit_distance(name, candidate, max_distance)
+            if distance <= max_distance:
+                ranked.append((distance, -count, candidate))
+                ranked.sort()
+                if len(ranked) >= limit:
+                    # only closer names can still be suggested
+                    del ranked[limit:]
+                    max_distance = ranked[-1][0]
+        return [candidate for _, _, candidate in ranked]
+
+    def complete(self, prefix, limit=20):
+        ''' Return up to limit names starting with prefix, in order, or the
+        names closest to prefix if none does. '''
+        names = self.names
+        i = bisect_left(names, prefix)
+        found = []
+        while i < len(names) and len(found) < limit and names[i].startswith(prefix):
+            found.append(names[i])
+            i += 1
+        return found or self.suggest(prefix, limit)
+
+    def did_you_mean(self, name):
+        ''' Return a sentence suggesting the names close to name, or ''. '''
+        names = self.suggest(name)
+        if not names:
+            return ''
+        return ' (did you mean ' + ', '.join(f'`{name}`' for name in names) + '?)'
@@ -0,0 +1,230 @@
+'''Indexes over a ROM image, built once and kept on disk.
+
+XrefIndex holds the come-from graph used by `find_equivalent_addresses`:
+for every branch target, the addresses of the BC AL / B / BL instructions
+jumping to it. It is stored CSR-style as three arrays of uint32:
+
+    targets   sorted branch targets
+    offsets   sources of targets[k] are sources[offsets[k]:offsets[k + 1]]
+    sources   addresses of the branch instructions
+
+WordIndex holds, for every 16-bit word value, the sorted addresses of the
+aligned words of the ROM with that value, to find byte sequences
+(`optimize_gadget_f`) without comparing at every address.
+
+The files are named after the SHA-256 of the ROM and memory-mapped when
+loaded, so a ROM is only scanned the first time it is seen.
+'''
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from heapq import merge
+
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'romindex_cache')
+# magic, version, ROM hash
+_HEADER = struct.Struct('<4sI32s')
+
+
+def rom_hash(rom):
+    return hashlib.sha256(rom).digest()
+
+
+def save_arrays(filename, magic, version, digest, arrays):
+    ''' Write uint32 arrays to filename, after a header and their lengths. '''
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(magic, version, digest))
+        f.write(struct.pack(f'<{len(arrays)}I', *map(len, arrays)))
+        for a in arrays:
+            a.tofile(f)
+    os.replace(tmp, filename)
+
+
+def load_arrays(filename, magic, version, digest, n_arrays):
+    ''' Map the arrays written by save_arrays. Return them as memoryviews,
+    or None if the file is not for this magic, version and digest. '''
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = _HEADER.size + 4 * n_arrays
+    if len(data) < start or _HEADER.unpack_from(data) != (magic, version, digest):
+        return None
+    lengths = struct.unpack_from(f'<{n_arrays}I', data, _HEADER.size)
+    if len(data) != start + 4 * sum(lengths):
+        return None
+    words = memoryview(data)[start:].cast('I')
+    arrays = []
+    for length in lengths:
+        arrays.append(words[:length])
+        words = words[length:]
+    return arrays
+
+
+def scan_xrefs(rom):
+    ''' Return {target: [source addresses]} of the branches in rom. '''
+    comefrom = {}
+    even, odd = rom[0::2], rom[1::2]
+
+    def add(target, i):
+        comefrom.setdefault(target, []).append(i)
+
+    # BC AL: rom[i + 1] == 0xce
+    j = odd.find(0xce)
+    while j >= 0:
+        i = 2 * j
+        offset = rom[i]
+        if offset >= 128:
+            offset -= 256
+        # in the segment of the instruction
+        add(i & 0xf0000 | ((i + (offset + 1) * 2) & 0xffff), i)
+        j = odd.find(0xce, j + 1)
+
+    # B and BL / POP PC both have (rom[i + 1] & 0xf0) == 0xf0
+    for match in re.finditer(rb'[\xf0-\xff]', odd):
+        j = match.start()
+        i = 2 * j
+        if even[j] == 0x00:  # B
+            if i < len(rom) - 2:
+                add((rom[i + 1] & 0x0f) << 16 | rom[i + 3] << 8 | rom[i + 2], i)
+        elif even[j] == 0x01:  # BL / POP PC
+            if (i < len(rom) - 4 and
+                    (rom[i + 4] & 0xf0) == 0x8e and
+                    (rom[i + 5] & 0xf0) == 0xf2):
+                add((rom[i + 1] & 0x0f) << 16 | rom[i + 3] << 8 | rom[i + 2], i)
+
+    return comefrom
+
+
+class XrefIndex:
+    ''' The come-from graph of a ROM, see the module docstring. '''
+    MAGIC = b'XREF'
+    VERSION = 2
+    N_ARRAYS = 3
+
+    def __init__(self, rom, targets, offsets, sources):
+        self.targets = targets
+        self.offsets = offsets
+        self.sources = sources
+
+    @classmethod
+    def build(cls, rom):
+        comefrom = scan_xrefs(rom)
+        targets, offsets, sources = array('I'), array('I', [0]), array('I')
+        for target in sorted(comefrom):
+            targets.append(target)
+            sources.extend(sorted(comefrom[target]))
+            offsets.append(len(sources))
+        return cls(rom, targets, offsets, sources)
+
+    def arrays(self):
+        return self.targets, self.offsets, self.sources
+
+    def comefrom(self, adr):
+        ''' Return the addresses of the branches to adr. '''
+        k = bisect_left(self.targets, adr)
+        if k < len(self.targets) and self.targets[k] == adr:
+            return self.sources[self.offsets[k]:self.offsets[k + 1]]
+        return ()
+
+    def closure(self, q):
+        ''' Return the addresses in q and all that branch to them, directly
+        or not. q is emptied. '''
+        ans = set()
+        while q:
+            adr = q.pop()
+            if adr in ans:
+                continue
+            ans.add(adr)
+            q.update(self.comefrom(adr))
+        return ans
+
+
+class WordIndex:
+    ''' Addresses of the aligned words of a ROM by value, see the module
+    docstring. Positions of the word w are positions[offsets[w]:offsets[w + 1]]. '''
+    MAGIC = b'WORD'
+    VERSION = 1
+    N_ARRAYS = 2
+
+    def __init__(self, rom, offsets, positions):
+        self.rom = rom
+        self.offsets = offsets
+        self.positions = positions
+
+    @classmethod
+    def build(cls, rom):
+        words = array('H', rom[:len(rom) & ~1])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        counts = [0] * 0x10000
+        for word in words:
+            counts[word] += 1
+        offsets = array('I', [0])
+        for count in counts:
+            offsets.append(offsets[-1] + count)
+        positions = array('I', sorted(range(0, len(words) * 2, 2), key=lambda i: words[i >> 1]))
+        return cls(rom, offsets, positions)
+
+    def arrays(self):
+        return self.offsets, self.positions
+
+    def word_positions(self, word):
+        return self.positions[self.offsets[word]:self.offsets[word + 1]]
+
+    def find(self, seq):
+        ''' Return the sorted even addresses where seq (bytes) occurs in the
+        ROM, also when seq does not end on a word boundary. '''
+        rom = self.rom
+        n_words = len(seq) // 2
+        if n_words == 0:
+            if not seq:
+                return list(range(0, len(rom) + 1, 2))
+            # any word with this low byte
+            return list(merge(*(self.word_positions(seq[0] | high << 8) for high in range(256))))
+        # look up the rarest word of seq, then compare the rest
+        words = [seq[2 * k] | seq[2 * k + 1] << 8 for k in range(n_words)]
+        k = min(range(n_words), key=lambda k: self.offsets[words[k] + 1] - self.offsets[words[k]])
+        return [i - 2 * k for i in self.word_positions(words[k])
+                if i >= 2 * k and rom.startswith(seq, i - 2 * k)]
+
+
+_indexes = {}  # (index class, id(rom)) -> (rom, index)
+_indexes_lock = threading.Lock()
+
+
+def get_index(cls, rom):
+    ''' Return the cls index of rom, from memory, from INDEX_DIR or built. '''
+    cached = _indexes.get((cls, id(rom)))
+    if cached is not None and cached[0] is rom:
+        return cached[1]
+    with _indexes_lock:
+        digest = rom_hash(rom)
+        filename = os.path.join(INDEX_DIR, f'{digest.hex()}.{cls.MAGIC.decode().lower()}')
+        try:
+            arrays = load_arrays(filename, cls.MAGIC, cls.VERSION, digest, cls.N_ARRAYS)
+        except (OSError, ValueError):
+            arrays = None
+        if arrays is not None:
+            index = cls(rom, *arrays)
+        else:
+            index = cls.build(rom)
+            try:
+                os.makedirs(INDEX_DIR, exist_ok=True)
+                save_arrays(filename, cls.MAGIC, cls.VERSION, digest, index.arrays())
+            except OSError:
+                pass  # read-only tree, keep it in memory only
+        _indexes[cls, id(rom)] = rom, index
+    return index
+
+
+def get_xref_index(rom):
+    return get_index(XrefIndex, rom)
+
+
+def get_word_index(rom):
+    return get_index(WordIndex, rom)
@@ -0,0 +1,167 @@
+"""
+Memory-mapped index of a disassembly, built once from its text file
+
+The index of a file is stored in INDEX_DIR as `<SHA-256 of the text>.disas`:
+after a header come the arrays
+
+    addrs     sorted addresses of the instructions (uint32)
+    strings   the instruction at addrs[k] is the string number strings[k]
+    chains    the pop chain summary of the code at addrs[k] (uint32): bytes
+              popped | `leave` count << 16 | end kind << 24
+    offsets   string i is pool[offsets[i]:offsets[i + 1]] (uint32)
+    pool      the distinct instructions, UTF-8
+
+Every process maps the same file, so the workers of a server share its
+pages instead of each parsing the text into a dict of its own.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'disas_cache')
+MAGIC = b'DISA'
+VERSION = 2
+# magic, version, hash of the text, lengths of addrs, strings, chains, offsets and pool
+_HEADER = struct.Struct('<4sI32s5I')
+
+
+class DisasIndex(Mapping):
+    """
+    {addr: instruction} read from the arrays above, a drop-in for the dict of get_disas
+    """
+    def __init__(self, addrs, strings, chains, offsets, pool):
+        self.addrs = addrs
+        self.strings = strings
+        self.chains = chains
+        self.offsets = offsets
+        self.pool = pool
+
+    @classmethod
+    def build(cls, disas, summarize):
+        """
+        Builds the arrays of a dict {addr: instruction}; summarize(addr, disas)
+        gives the (bytes popped, `leave` count, end kind) of the code at addr
+        """
+        addrs = array('I', sorted(disas))
+        strings, chains, offsets, pool = array('I'), array('I'), array('I', [0]), bytearray()
+        numbers = {}  # instruction -> string number
+        for addr in addrs:
+            text = disas[addr]
+            i = numbers.get(text)
+            if i is None:
+                i = numbers[text] = len(numbers)
+                pool += text.encode('utf-8')
+                offsets.append(len(pool))
+            strings.append(i)
+            popped, leaves, end = summarize(addr, disas)
+            chains.append(min(popped, 0xFFFF) | min(leaves, 0xFF) << 16 | end << 24)
+        return cls(addrs, strings, chains, offsets, bytes(pool))
+
+    def find(self, addr):
+        """
+        Returns the position of addr in addrs, -1 if it is not there
+        """
+        addrs = self.addrs
+        k = bisect_left(addrs, addr)
+        if k < len(addrs) and addrs[k] == addr:
+            return k
+        return -1
+
+    def pop_chain(self, addr):
+        """
+        Returns the (bytes popped, `leave` count, end kind) of the code at
+        addr, None if addr is not in the disassembly
+        """
+        k = self.find(addr)
+        if k < 0:
+            return None
+        chain = self.chains[k]
+        return chain & 0xFFFF, chain >> 16 & 0xFF, chain >> 24
+
+    def string(self, i):
+        return str(self.pool[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __contains__(self, addr):
+        return isinstance(addr, int) and self.find(addr) >= 0
+
+    def __getitem__(self, addr):
+        k = self.find(addr) if isinstance(addr, int) else -1
+        if k < 0:
+            raise KeyError(addr)
+        return self.string(self.strings[k])
+
+    def __iter__(self):
+        return iter(self.addrs)
+
+    def __len__(self):
+        return len(self.addrs)
+
+
+def save_index(filename, digest, index):
+    arrays = index.addrs, index.strings, index.chains, index.offsets
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, digest, *map(len, arrays), len(index.pool)))
+        for a in arrays:
+            a.tofile(f)
+        f.write(index.pool)
+    os.replace(tmp, filename)
+
+
+def load_index(filename, digest):
+    """
+    Maps the index written by save_index, None if it is not for this text
+    """
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, file_digest, *lengths, pool_length = _HEADER.unpack_from(data)
+    if (magic, version, file_digest) != (MAGIC, VERSION, digest):
+        return None
+    if len(data) != _HEADER.size + 4 * sum(lengths) + pool_length:
+        return None
+    view = memoryview(data)[_HEADER.size:]
+    arrays = []
+    for length in lengths:
+        arrays.append(view[:4 * length].cast('I'))
+        view = view[4 * length:]
+    return DisasIndex(*arrays, view)
+
+
+_indexes = {}  # digest -> DisasIndex
+_indexes_lock = threading.Lock()
+
+
+def get_disas_index(file_path, parse, summarize):
+    """
+    Returns the DisasIndex of the disassembly file, mapped from INDEX_DIR,
+    or built from parse(file_path) and saved there the first time
+    """
+    with open(file_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).digest()
+    with _indexes_lock:
+        index = _indexes.get(digest)
+        if index is not None:
+            return index
+        filename = os.path.join(INDEX_DIR, f'{digest.hex()}.disas')
+        try:
+            index = load_index(filename, digest)
+        except (OSError, ValueError):
+            index = None
+        if index is None:
+            index = DisasIndex.build(parse(file_path), summarize)
+            try:
+                os.makedirs(INDEX_DIR, exist_ok=True)
+                save_index(filename, digest, index)
+                # use the shared pages rather than this copy
+                index = load_index(filename, digest) or index
+            except (OSError, ValueError):
+                pass  # read-only tree, keep it in memory only
+        _indexes[digest] = index
+    return index
@@ -1,8 +1,15 @@
 # pyu16decomp v2.1
 # Created by luongvantam last created: 11:46 AM 08-23-2025(GMT+7)
 # Last modified: 3:05 PM 10-14-2025(GMT+7)
+import importlib.util
 import os
 import re
+import threading
+from array import array
+from collections import namedtuple
+from bisect import bisect_right
+
+from disasindex import DisasIndex, get_disas_index
 
 max_call_adr = 0x3ffff
 
@@ -56,6 +63,16 @@ def get_disas(file_path: str) -> dict:
     return data
 
 
+def load_disas(file_path: str):
+    """
+    Returns the disassembly of file_path as a DisasIndex (see disasindex.py),
+    shared by the processes mapping it, or {} if there is no such file
+    """
+    if not os.path.exists(file_path):
+        return {}
+    return get_disas_index(file_path, get_disas, pop_chain_summary)
+
+
 def get_commands(file_path: str) -> dict:
     """
     Reads the file gadget.txt or labels.txt, returns dict {addr: line}
@@ -82,21 +99,157 @@ def get_commands(file_path: str) -> dict:
     return data
 
 
-def load_hex_buffer(lines):
+# A gadget line parsed for decompile: the registers it pops as (name, bytes)
+# and their total, whether it is a `sp = ..., pop ...` (shown as is) and
+# whether the line is shown when it pops nothing
+GadgetRecord = namedtuple('GadgetRecord', 'line regs total sp_pop echo')
+# A label line parsed for decompile: the bytes popped after `, pop`
+LabelRecord = namedtuple('LabelRecord', 'line total')
+
+
+def gadget_record(line: str) -> GadgetRecord:
+    line = line.strip()
+    low = line.lower()
+    if low.startswith("sp =") and "pop" in low:
+        return GadgetRecord(line, (), 0, True, True)
+    if 'pop' not in low:
+        return GadgetRecord(line, (), 0, False, True)
+    parts = re.split(r'\bpop\b', line, 1)
+    if len(parts) < 2:
+        return GadgetRecord(line, (), 0, False, True)
+    before_pop, tail = parts
+    regs = []
+    for tok in re.split(r'[\s,]+', tail):
+        tok_l = tok.strip().strip(',').lower()
+        if not tok_l:
+            continue
+        if tok_l == 'pc' or tok_l == 'rt':
+            break
+        if re.fullmatch(r'[a-z0-9]+', tok_l):
+            regs.append((tok_l, reg_bytes(tok_l)))
+    return GadgetRecord(line, tuple(regs), sum(size for _, size in regs), False,
+                        bool(before_pop.strip()))
+
+
+def label_record(line: str) -> LabelRecord:
+    low = line.lower()
+    if not re.search(r',\s*pop', low):
+        return LabelRecord(line, 0)
+    tail = re.split(r',\s*pop', low, maxsplit=1)[1]
+    regs = [r.strip().strip(',') for r in re.split(r'[\s,]+', tail) if r.strip()]
+    return LabelRecord(line, sum(reg_bytes(r) for r in regs))
+
+
+def get_records(file_path: str, record) -> dict:
+    """
+    get_commands with every line parsed by record (gadget_record or
+    label_record) once, returns dict {addr: record}
+    """
+    return {addr: record(line) for addr, line in get_commands(file_path).items()}
+
+
+def load_config(file_path: str):
+    """
+    Executes config.py of a model, returns it as a module
+    """
+    spec = importlib.util.spec_from_file_location('config', file_path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    return config
+
+
+MODEL_FILES = ('config.py', 'disas', 'gadgets', 'labels')
+
+
+class DecompilerModel:
+    """
+    Parsed config, disassembly, gadgets and labels of a model directory
+    """
+    def __init__(self, model_dir):
+        self.name = os.path.basename(model_dir)
+        config_path = os.path.join(model_dir, 'config.py')
+        if not os.path.exists(config_path):
+            raise FileNotFoundError(f'Không tìm thấy config.py cho model {self.name}')
+        self.config = load_config(config_path)
+        self.disas = load_disas(os.path.join(model_dir, 'disas'))
+        self.gadgets = get_records(os.path.join(model_dir, 'gadgets'), gadget_record)
+        self.labels = get_records(os.path.join(model_dir, 'labels'), label_record)
+        self.addresses = AddressIndex(self.gadgets, self.disas, self.labels)
+        self.start_ram = self.config.start_ram
+        self.end_ram = self.config.end_ram
+
+    def pop_chain(self, addr):
+        """
+        (bytes popped, `leave` count, END_* kind) of the code at addr, for
+        tools checking the stack depth of a chain, see pop_chain_summary
+        """
+        return pop_chain(addr, self.disas)
+
+
+def model_signature(model_dir):
+    """
+    (mtime, size) of every model file, changes when one of them is edited
+    """
+    signature = []
+    for name in MODEL_FILES:
+        try:
+            st = os.stat(os.path.join(model_dir, name))
+        except OSError:
+            signature.append(None)
+        else:
+            signature.append((st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+_model_cache = {}  # model_dir -> (signature, DecompilerModel)
+_model_cache_lock = threading.Lock()
+
+
+def get_model(model_dir):
+    """
+    Returns the DecompilerModel of model_dir, parsed only once per process
+    and again when a model file changes on disk
+    """
+    model_dir = os.path.abspath(model_dir)
+    signature = model_signature(model_dir)
+    cached = _model_cache.get(model_dir)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with _model_cache_lock:
+        cached = _model_cache.get(model_dir)
+        if cached is None or cached[0] != signature:
+            cached = signature, DecompilerModel(model_dir)
+            _model_cache[model_dir] = cached
+    return cached[1]
+
+
+def warm_up(models_dir):
+    """
+    Loads every model in models_dir into the cache, returns their names
+    """
+    loaded = []
+    for name in sorted(os.listdir(models_dir)):
+        model_dir = os.path.join(models_dir, name)
+        if os.path.isfile(os.path.join(model_dir, 'config.py')):
+            get_model(model_dir)
+            loaded.append(name)
+    return loaded
+
+
+def load_bytes(lines) -> bytes:
+    """
+    Returns the bytes written as pairs of hex digits in lines
+    """
     joined = ' '.join(line.strip() for line in lines if line.strip())
-    tokens = re.findall(r'[0-9A-Fa-f]{2}', joined)
-    return ''.join(tokens).lower()
+    return bytes.fromhex(''.join(re.findall(r'[0-9A-Fa-f]{2}', joined)))
 
 
-def swap_bytes_and_convert(hex8: str) -> int:
-    s = hex8.strip()
-    if len(s) != 8:
-        raise ValueError("need 8 hex chars")
-    b1 = s[0:2]
-    b2 = s[2:4]
-    b3 = s[4:6]
-    addr_hex = f"{b3[1]}{b2}{b1}"
-    return int(addr_hex, 16) & 0xFFFFF
+def word_address(buf, pos: int) -> int:
+    """
+    The address called by the little-endian word at buf[pos:pos + 4]: the
+    low nibble of its third byte is the segment
+    """
+    return int.from_bytes(buf[pos:pos + 3], 'little') & 0xFFFFF
 
 
 def reg_bytes(reg: str) -> int:
@@ -108,14 +261,27 @@ def reg_bytes(reg: str) -> int:
     return 0
 
 
-def consume_pop_chain_from_disas(addr, disas, hex_buffer, idx, state=None, max_instr=50):
-    out = [f"call 0x{addr:X}"]
-    total_bytes_for_print = 0
+# how the code walked by pop_chain_summary ends
+END_POP_PC, END_RT, END_BRANCH, END_GAP, END_LIMIT = range(5)
+POP_CHAIN_MAX_INSTR = 50
+
+
+def pop_chain_summary(addr, disas, max_instr=POP_CHAIN_MAX_INSTR):
+    """
+    Walks the disassembly from addr, returns (bytes popped from the stack,
+    `leave` count, END_* kind); a pop of a register pushed before does not
+    count, a `leave` takes 12 bytes
+    """
+    total_bytes = leaves = 0
     cur = addr
     push_stack = []
     count_instr = 0
 
-    while cur in disas and count_instr < max_instr:
+    while True:
+        if cur not in disas:
+            return total_bytes, leaves, END_GAP
+        if count_instr >= max_instr:
+            return total_bytes, leaves, END_LIMIT
         inst = disas[cur].strip().lower()
         count_instr += 1
 
@@ -128,49 +294,94 @@ def consume_pop_chain_from_disas(addr, disas, hex_buffer, idx, state=None, max_i
         if inst.startswith('pop '):
             reg = inst.split()[1]
             if reg == 'pc':
-                break
+                return total_bytes, leaves, END_POP_PC
             if reg in push_stack:
                 push_stack.remove(reg)
             else:
-                total_bytes_for_print += reg_bytes(reg)
+                total_bytes += reg_bytes(reg)
             cur += 2
             continue
 
-        inst_lower = inst.strip()
-        if inst_lower == 'b leave' or inst_lower.endswith('leave'):
-            total_bytes_for_print += 12
-            if state:
-                state.add_to_sp(12)
+        if inst == 'b leave' or inst.endswith('leave'):
+            total_bytes += 12
+            leaves += 1
             cur += 2
             continue
 
         if inst.startswith('rt'):
-            break
+            return total_bytes, leaves, END_RT
 
         if inst.startswith('bl ') or inst.startswith('b '):
-            break
+            return total_bytes, leaves, END_BRANCH
 
         cur += 2
 
-    if total_bytes_for_print > 0 and idx + total_bytes_for_print*2 <= len(hex_buffer):
-        blob = hex_buffer[idx: idx + total_bytes_for_print*2]
-        spaced = ' '.join(blob[j:j+2] for j in range(0, len(blob), 2))
-        out.append(f"hex {spaced}")
-        idx += total_bytes_for_print*2
 
-    return out, idx
+def pop_chain(addr, disas):
+    """
+    pop_chain_summary of addr, from the table of a DisasIndex (built once
+    per disassembly) or walked in a dict
+    """
+    if isinstance(disas, DisasIndex):
+        return disas.pop_chain(addr) or (0, 0, END_GAP)
+    return pop_chain_summary(addr, disas)
+
+
+def consume_pop_chain_from_disas(addr, disas, buf, pos, state=None, max_instr=POP_CHAIN_MAX_INSTR):
+    out = [f"call 0x{addr:X}"]
+    if max_instr == POP_CHAIN_MAX_INSTR:
+        total_bytes_for_print, leaves, end = pop_chain(addr, disas)
+    else:
+        total_bytes_for_print, leaves, end = pop_chain_summary(addr, disas, max_instr)
+    if state:
+        for _ in range(leaves):
+            state.add_to_sp(12)
 
+    if total_bytes_for_print > 0 and pos + total_bytes_for_print <= len(buf):
+        out.append(f"hex {buf[pos:pos + total_bytes_for_print].hex(' ')}")
+        pos += total_bytes_for_print
+
+    return out, pos
+
+
+# where an address of AddressIndex is known from
+LABEL, GADGET, DISAS = 1, 2, 4
+
+
+class AddressIndex:
+    """
+    The addresses of the labels, gadgets and disassembly, with the sources of
+    each as LABEL | GADGET | DISAS flags. The disassembly addresses are
+    searched where they are, the mmapped array of a DisasIndex shared by the
+    workers; only the labels and gadgets get arrays of their own
+    """
+    def __init__(self, gadgets, disas, labels):
+        # a DisasIndex is sorted already
+        self.disas_addrs = disas.addrs if hasattr(disas, 'addrs') else sorted(disas)
+        known = {}
+        for source, table in ((LABEL, labels), (GADGET, gadgets)):
+            for addr in table:
+                known[addr] = known.get(addr, 0) | source
+        self.addrs = array('I', sorted(known))
+        self.flags = bytes(known[addr] for addr in self.addrs)
+
+    def resolve(self, addr, max_fallback=4):
+        """
+        Returns (the nearest known address at or below addr, within
+        max_fallback bytes, its flags), or (addr, 0) if there is none
+        """
+        k = bisect_right(self.addrs, addr) - 1
+        nearest = self.addrs[k] if k >= 0 else -1
+        i = bisect_right(self.disas_addrs, addr) - 1
+        disas_nearest = self.disas_addrs[i] if i >= 0 else -1
+        best = max(nearest, disas_nearest)
+        if best < 0 or addr - best > max_fallback:
+            return addr, 0
+        flags = self.flags[k] if nearest == best else 0
+        if disas_nearest == best:
+            flags |= DISAS
+        return best, flags
 
-def resolve_address(addr, gadgets, disas, labels, max_fallback=4):
-    cur = addr
-    attempts = 0
-    while cur >= 0 and attempts <= max_fallback:
-        if cur in gadgets or cur in disas or cur in labels:
-            return cur
-        cur -= 1
-        attempts += 1
-    return addr
-            
 
 class DecompilerState:
     def __init__(self):
@@ -198,9 +409,12 @@ class DecompilerState:
         return self.sp
 
 
-def decompile(inp, outp, disas, gadgets, labels, start_ram, end_ram, output_lines=None):
+def decompile(inp, outp, disas, gadgets, labels, start_ram, end_ram, output_lines=None,
+              addresses=None):
     if output_lines is None:
         output_lines = []
+    if addresses is None:
+        addresses = AddressIndex(gadgets, disas, labels)
     state = DecompilerState()  # tạo mới mỗi lần decompile
 
     with open(inp, 'r', encoding='utf-8') as fh_in:
@@ -263,106 +477,65 @@ def decompile(inp, outp, disas, gadgets, labels, start_ram, end_ram, output_line
             bytes_consumed = len(text_content)
             state.update_position(bytes_consumed)
         else:
-            hex_buffer = load_hex_buffer([segment])
+            buf = load_bytes([segment])
             i = 0
-            n = len(hex_buffer)
-
-            while i + 8 <= n:
-                chunk = hex_buffer[i:i+8]
-                original_hex_part = chunk
-                try:
-                    raw_addr = swap_bytes_and_convert(chunk)
-                    addr = resolve_address(raw_addr, gadgets, disas, labels)
-                except Exception as e:
-                    raise ValueError(f"Failed to parse chunk {chunk} at index {i}: {e}")
-
-                i += 8
+            n = len(buf)
+
+            while i + 4 <= n:
+                raw_addr = word_address(buf, i)
+                addr, found = addresses.resolve(raw_addr)
+
+                i += 4
                 state.update_position(4)
                 
                 if not (0x00000 <= raw_addr <= max_call_adr):
-                    spaced = ' '.join(original_hex_part[j:j+2] for j in range(0, len(original_hex_part), 2))
-                    output_lines.append(f"hex {spaced}\n")
+                    output_lines.append(f"hex {buf[i - 4:i].hex(' ')}\n")
                     continue
 
-                if addr in labels:
-                    line = labels[addr]
-                    output_lines.append(f"{line}\n")
-                    low = line.lower()
-                    if re.search(r',\s*pop', low):
-                        tail = re.split(r',\s*pop', low, maxsplit=1)[1]
-                        regs = [r.strip().strip(',') for r in re.split(r'[\s,]+', tail) if r.strip()]
-                        total = sum(reg_bytes(r) for r in regs)
-                        if total > 0 and i + total*2 <= n:
-                            blob = hex_buffer[i:i + total*2]
-                            spaced = ' '.join(blob[j:j+2] for j in range(0, len(blob), 2))
-                            output_lines.append(f"hex {spaced}\n")
-                            i += total*2
-                            state.update_position(total)
+                if found & LABEL:
+                    record = labels[addr]
+                    if isinstance(record, str):
+                        record = label_record(record)
+                    output_lines.append(f"{record.line}\n")
+                    total = record.total
+                    if total > 0 and i + total <= n:
+                        output_lines.append(f"hex {buf[i:i + total].hex(' ')}\n")
+                        i += total
+                        state.update_position(total)
                     continue
 
-                if addr in gadgets:
-                    line = gadgets[addr].strip()
-                    low = line.lower()
-                    if low.startswith("sp =") and "pop" in low:
-                        output_lines.append(f"{line}\n")
-                        continue
+                if found & GADGET:
+                    record = gadgets[addr]
+                    if isinstance(record, str):
+                        record = gadget_record(record)
 
-                    regs = []
-                    if 'pop' in low:
-                        tail = re.split(r'\bpop\b', line, 1)[1]
-                        toks = [t.strip().strip(',') for t in re.split(r'[\s,]+', tail) if t.strip()]
-                        for tok in toks:
-                            tok_l = tok.lower().strip(',')
-                            if tok_l == 'pc' or tok_l == 'rt':
-                                break
-                            if re.fullmatch(r'[a-z0-9]+', tok_l):
-                                regs.append(tok_l)
-
-                    total = sum(reg_bytes(r) for r in regs) if regs else 0
-                    before_pop = ''
-                    if 'pop' in low:
-                        before_pop = re.split(r'\bpop\b', line, 1)[0].strip()
-
-                    if regs and total > 0:
-                        off = 0
-                        for idx, r in enumerate(regs):
-                            rb = reg_bytes(r)
-                            bytes_left = n - i
-                            if bytes_left >= rb*2:
-                                part = hex_buffer[i:i+rb*2]
-                                spaced = ' '.join(part[j:j+2] for j in range(0, len(part), 2))
-                                output_lines.append(f"{r} = hex {spaced}\n")
-                                i += rb*2
+                    if record.total > 0:
+                        for r, rb in record.regs:
+                            if n - i >= rb:
+                                output_lines.append(f"{r} = hex {buf[i:i + rb].hex(' ')}\n")
+                                i += rb
                                 state.update_position(rb)
                             else:
                                 output_lines.append(f"pop {r}\n")
                         continue
 
-                    if 'pop' in low and before_pop:
-                        output_lines.append(f"{line}\n")
-                        continue
-                    elif 'pop' in low and not before_pop:
-                        continue
-                    output_lines.append(f"{line}\n")
+                    if record.echo:
+                        output_lines.append(f"{record.line}\n")
                     continue
 
-                if addr in disas:
-                    lines, new_i = consume_pop_chain_from_disas(addr, disas, hex_buffer, i, state)
+                if found & DISAS:
+                    lines, new_i = consume_pop_chain_from_disas(addr, disas, buf, i, state)
                     for L in lines:
                         output_lines.append(f"{L}\n")
-                    bytes_consumed = (new_i - i) // 2
-                    state.update_position(bytes_consumed)
+                    state.update_position(new_i - i)
                     i = new_i
                     continue
                 
                 output_lines.append(f"call 0x{addr:X}\n")
                 state.update_position(4)
 
-            rem = n - i
-            if rem == 4:
-                leftover = hex_buffer[i:i+4]
-                spaced = ' '.join(leftover[j:j+2] for j in range(0, len(leftover), 2))
-                output_lines.append(f"hex {spaced}\n")
+            if n - i == 2:
+                output_lines.append(f"hex {buf[i:].hex(' ')}\n")
                 state.update_position(2)
                 
     return output_lines
\ No newline at end of file
@@ -9,19 +9,27 @@ import json
 import threading
 import webbrowser
 import tempfile
-import importlib.util
 import sys
+import glob
 
 # Thêm đường dẫn để import libdecompiler
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'asmapp', 'decompiler'))
 try:
-    from libdecompiler import get_disas, get_commands, decompile
+    from libdecompiler import get_model, warm_up, decompile, MODEL_FILES
 except ImportError:
     print("⚠️  Không thể import libdecompiler. Chức năng decompiler sẽ không hoạt động.")
-    def get_disas(*args, **kwargs): raise NotImplementedError
-    def get_commands(*args, **kwargs): raise NotImplementedError
+    MODEL_FILES = ()
+    def get_model(*args, **kwargs): raise NotImplementedError
+    def warm_up(*args, **kwargs): raise NotImplementedError
     def decompile(*args, **kwargs): raise NotImplementedError
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'asmapp', 'compiler'))
+from compiler_pool import CompilerPool, LocalCompiler, evaluates_python
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'util'))
+from spell import spell as spell_lines
+from resultcache import ResultCache, result_key, files_digest
+
 # Thư mục gốc của dự án (nơi chứa file run.py)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -71,8 +79,78 @@ def check_decompiler_models():
             print(f"⚠️  Model '{model}' thiếu: {', '.join(missing)}")
 check_decompiler_models()
 
+# Nạp sẵn các model decompiler vào cache (chỉ parse lại khi file model thay đổi)
+def warm_up_decompiler_models():
+    try:
+        warm_up(DECOMPILER_MODELS_DIR)
+    except Exception as e:
+        print(f"⚠️  Không thể nạp sẵn decompiler models: {e}")
+warm_up_decompiler_models()
+
+# ===== COMPILER POOL =====
+# Mỗi model có một nhóm tiến trình compiler đã nạp sẵn rom/gadgets/labels.
+# COMPILER_POOL_SIZE=0: compile ngay trong tiến trình này (dùng với gunicorn gthread)
+COMPILER_POOL_SIZE = int(os.environ.get("COMPILER_POOL_SIZE", 2))
+COMPILER_POOL_MAX_JOBS = int(os.environ.get("COMPILER_POOL_MAX_JOBS", 500))
+COMPILER_POOLS = {}
+COMPILER_DIGESTS = {}  # model -> hash của các file compiler đã nạp
+
+def start_compiler_pools():
+    for model in MODELS:
+        model_dir = os.path.join(COMPILER_BASE, model)
+        if not os.path.exists(os.path.join(model_dir, 'compiler_.py')):
+            continue
+        # mọi module của compiler, dữ liệu model, thư viện lib/*.asm và RAM
+        # trong config.py của decompiler model
+        COMPILER_DIGESTS[model] = files_digest(
+            [os.path.join(model_dir, name) for name in
+             ('compiler_.py', 'get_char_table.py', 'rom.bin', 'gadgets', 'labels')] +
+            [os.path.join(COMPILER_BASE, 'labels_sfr'),
+             os.path.join(DECOMPILER_MODELS_DIR, model, 'config.py')] +
+            sorted(glob.glob(os.path.join(COMPILER_BASE, '*.py'))) +
+            sorted(glob.glob(os.path.join(COMPILER_BASE, 'lib', '*.asm')))
+        )
+        if COMPILER_POOL_SIZE == 0:
+            try:
+                COMPILER_POOLS[model] = LocalCompiler(model_dir).start()
+            except Exception as e:
+                print(f"⚠️  Không thể nạp compiler {model}: {e}")
+        else:
+            COMPILER_POOLS[model] = CompilerPool(
+                model_dir, size=COMPILER_POOL_SIZE, max_jobs=COMPILER_POOL_MAX_JOBS
+            ).start()
+
+start_compiler_pools()
+
+# ===== RESULT CACHE =====
+# Kết quả của /asm và /decompile theo (endpoint, model, hash dữ liệu model, hash code)
+RESULT_CACHE = ResultCache(int(os.environ.get("RESULT_CACHE_BYTES", 32 * 1024 * 1024)))
+
 app = Flask(__name__, static_folder=None)
 
+def cached_response(key):
+    # Client đã có kết quả (If-None-Match) thì không cần chạy lại
+    if key in request.if_none_match:
+        RESULT_CACHE.revalidated()
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+    body = RESULT_CACHE.get(key)
+    if body is None:
+        return None
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(key)
+    return response
+
+def cache_response(key, response):
+    RESULT_CACHE.put(key, response.get_data())
+    response.set_etag(key)
+    return response
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(RESULT_CACHE.stats())
+
 # ===== BLACKLIST =====
 BLOCK_EXT = {".py", ".sh", ".php", ".asp", ".exe", ".dll", ".so"}
 BLOCK_FILES = {"run.py", "app.py", "config.py", ".env"}
@@ -134,51 +212,80 @@ def compiler():
     code = data["code"]
     model = data.get("model", "580vnx")
     try:
-        compiler_path = os.path.join(COMPILER_BASE, model, "compiler_.py")
-        if not os.path.exists(compiler_path):
+        pool = COMPILER_POOLS.get(model)
+        if pool is None:
             return jsonify({"returncode": -4, "stderr": f"Compiler {model} not found", "stdout": ""}), 404
-        # Dùng sys.executable thay vì "python" để đảm bảo đúng interpreter
-        p = subprocess.run(
-            [sys.executable, compiler_path, "-f", "hex"],
-            input=code, text=True, capture_output=True, timeout=15
-        )
-        return jsonify({"returncode": p.returncode, "stderr": p.stderr, "stdout": p.stdout})
-    except subprocess.TimeoutExpired:
+        # Trình soạn thảo gửi kèm "session": chỉ parse lại các dòng đã sửa,
+        # trả thêm "sourcemap" = [[dòng, start, end], ...] (byte tính từ home)
+        session = data.get("session")
+        # "format": "json": trả "result" = {home, org, end, length, data (hex),
+        # labels, warnings, notes} thay cho văn bản "stdout"
+        fmt = "json" if data.get("format") == "json" else "hex"
+        # "optimize": true: rút gọn chuỗi ROP (gộp pop, bỏ pop/setlr thừa)
+        optimize = bool(data.get("optimize"))
+        key = result_key("asm" if session is None else "asm+map", fmt, "O" if optimize else "",
+                         model, COMPILER_DIGESTS[model], code)
+        response = cached_response(key)
+        if response is not None:
+            return response
+        if session is None:
+            returncode, stdout, stderr = pool.compile(code, fmt, timeout=15, optimize=optimize)
+            body = {"returncode": returncode, "stderr": stderr}
+        else:
+            returncode, stdout, stderr, info = pool.compile_with_map(
+                code, str(session), fmt, timeout=15, optimize=optimize)
+            body = {"returncode": returncode, "stderr": stderr,
+                    "home": info.get("home"), "sourcemap": info.get("sourcemap", [])}
+        if fmt == "json":
+            body["result"] = json.loads(stdout) if returncode == 0 else None
+        else:
+            body["stdout"] = stdout
+        # Chỉ lưu kết quả compile thành công, không chạy Python (`$`)
+        if returncode != 0 or evaluates_python(code):
+            return jsonify(body)
+        return cache_response(key, jsonify(body))
+    except TimeoutError:
         return jsonify({"returncode": -2, "stderr": "compile timeout", "stdout": ""}), 408
     except Exception as e:
         return jsonify({"returncode": -5, "stderr": str(e), "stdout": ""}), 500
 
+# Gợi ý tên gadget/label cho trình soạn thảo: ?model=580vnx&prefix=pop&limit=20
+@app.route("/asm/complete", methods=["GET", "POST"])
+def asm_complete():
+    data = request.get_json(silent=True) or request.values
+    model = data.get("model", "580vnx")
+    prefix = str(data.get("prefix", ""))
+    try:
+        limit = min(max(int(data.get("limit", 20)), 1), 100)
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid limit"}), 400
+    pool = COMPILER_POOLS.get(model)
+    if pool is None:
+        return jsonify({"error": f"Compiler {model} not found"}), 404
+    try:
+        return jsonify({"names": pool.complete(prefix, limit, timeout=15)})
+    except TimeoutError:
+        return jsonify({"error": "timeout"}), 408
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # ===== SPELL API =====
 @app.route("/spell", methods=["POST"])
 def spell():
     data = request.get_json(silent=True)
     if not data or "code" not in data:
         return jsonify({"out": "invalid input", "returncode": -1}), 400
-    code = data["code"]
+    # giống như spell.py đọc stdin ở chế độ text
+    code = data["code"].replace("\r\n", "\n").replace("\r", "\n").replace("\n", "")
     try:
-        spell_path = os.path.join(BASE_DIR, "util", "spell.py")
-        if not os.path.exists(spell_path):
-            return jsonify({"out": "spell tool not found", "returncode": -4}), 404
-        p = subprocess.run(
-            [sys.executable, spell_path],
-            input=code, text=True, capture_output=True, timeout=10
-        )
-        return jsonify({"out": p.stdout if p.stdout else p.stderr, "returncode": p.returncode})
-    except subprocess.TimeoutExpired:
-        return jsonify({"out": "timeout", "returncode": -2}), 408
+        lines = spell_lines(code)
+        return jsonify({"out": "".join(f"{line}\n" for line in lines), "returncode": 0})
+    except ValueError as e:
+        return jsonify({"out": f"{e} Vui lòng nhập lại: \n", "returncode": 1})
     except Exception as e:
         return jsonify({"out": str(e), "returncode": -3}), 500
 
 # ===== DECOMPILER API =====
-def load_model_config(model_name):
-    config_path = os.path.join(DECOMPILER_MODELS_DIR, model_name, 'config.py')
-    if not os.path.exists(config_path):
-        raise FileNotFoundError(f'Không tìm thấy config.py cho model {model_name}')
-    spec = importlib.util.spec_from_file_location('config', config_path)
-    config = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(config)
-    return config
-
 @app.route("/decompile", methods=["POST"])
 def decompile_api():
     data = request.get_json(silent=True)
@@ -192,29 +299,34 @@ def decompile_api():
     if not os.path.isdir(model_path):
         return jsonify({"returncode": -1, "stderr": f"model {model} not found", "stdout": ""}), 400
 
+    key = result_key("decompile", model, files_digest(
+        [os.path.join(model_path, name) for name in MODEL_FILES] +
+        sorted(glob.glob(os.path.join(ASMAPP_BASE, 'decompiler', '*.py')))
+    ), code)
+    response = cached_response(key)
+    if response is not None:
+        return response
+
     with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, dir=tempfile.gettempdir()) as f:
         f.write(code)
         input_path = f.name
     output_path = tempfile.mktemp(suffix='.asm', dir=tempfile.gettempdir())
 
     try:
-        cfg = load_model_config(model)
-        disas = get_disas(os.path.join(model_path, 'disas'))
-        gadgets = get_commands(os.path.join(model_path, 'gadgets'))
-        labels = get_commands(os.path.join(model_path, 'labels'))
-
+        m = get_model(model_path)
         result_lines = decompile(
             input_path, output_path,
-            disas, gadgets, labels,
-            cfg.start_ram, cfg.end_ram
+            m.disas, m.gadgets, m.labels,
+            m.start_ram, m.end_ram,
+            addresses=m.addresses
         )
 
         asm_output = ''.join(result_lines)
-        return jsonify({
+        return cache_response(key, jsonify({
             "returncode": 0,
             "stderr": "",
             "stdout": asm_output
-        })
+        }))
 
     except Exception as e:
         return jsonify({
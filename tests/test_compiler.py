@@ -0,0 +1,168 @@
+import glob
+import json
+import os
+import sys
+
+import pytest
+
+COMPILER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'asmapp', 'compiler')
+sys.path.insert(0, COMPILER_DIR)
+
+from compiler_pool import EVAL_REFUSED, CompilerPool, LocalCompiler, evaluates_python  # noqa: E402
+from libcompiler import (  # noqa: E402
+    SNAPSHOT_MAGIC, STACK_MARGIN, build_object, read_ram_regions, read_snapshot, sources_digest)
+from nameindex import NameIndex  # noqa: E402
+
+MODELS = ('580vnx', '880btg')
+
+
+@pytest.fixture(scope='module', params=MODELS)
+def compiler(request):
+    return LocalCompiler(os.path.join(COMPILER_DIR, request.param)).start()
+
+
+def compile_json(compiler, code):
+    returncode, stdout, stderr = compiler.compile(code, 'json')
+    assert returncode == 0, stderr
+    return json.loads(stdout)
+
+
+def test_home_without_org(compiler):
+    # no `org`: home is searched by Model.pick_home
+    result = compile_json(compiler, 'home:\n    pop er0\n    adr_of [home]\n    setlr\n')
+    home = result['home']
+    assert result['labels'] == {'home': home}
+    assert result['end'] == home + result['length']
+    assert bytes.fromhex(result['data'])[4:6] == home.to_bytes(2, 'little')
+
+
+def test_sections_out_of_stack(compiler):
+    # the gadgets of the chain push below home, so no section goes there
+    result = compile_json(compiler, 'org 0xe9e0\nhome:\n    pop er0\n    adr_of [t]\n'
+                                    'section data(0x20)\nt:\n    0x1234\n')
+    section, = result['sections']
+    assert section['address'] + section['size'] <= result['home'] - STACK_MARGIN
+    assert all(stop <= result['home'] - STACK_MARGIN or start >= result['end']
+               for start, stop in result['free'])
+
+
+def test_ram_regions_end_excluded():
+    assert read_ram_regions('580vnx') == ((0xD000, 0xF000),)
+    # end_ram = 0xFFFF in the 880btg config: that byte is left out
+    assert read_ram_regions('880btg') == ((0x9000, 0xFFFF),)
+
+
+def test_880btg_layout():
+    compiler = LocalCompiler(os.path.join(COMPILER_DIR, '880btg')).start()
+    section = 'section data(0x100)\nt:\n    0x1234\n'
+    result = compile_json(compiler, 'org 0xe9e0\nhome:\n    pop er0\n    adr_of [t]\n' + section)
+    (address, size), = ((s['address'], s['size']) for s in result['sections'])
+    assert 0x9000 <= address and address + size <= 0xFFFF
+    assert max(stop for start, stop in result['free']) == 0xFFFF
+    # a section larger than the RAM fails, it is not placed past its end
+    returncode, stdout, stderr = compiler.compile(
+        'org 0xe9e0\nhome:\n    pop er0\n    adr_of [t]\nsection data(0x8000)\nt:\n    0x1234\n')
+    assert returncode != 0 and 'No room in RAM for section data (32768 bytes)' in stderr
+
+
+# arguments of each library entry, `src` and `label` being labels
+LIBRARY_ARGS = {
+    'backup580': '',
+    'backup880': '',
+    'loop580': '(10 00)',
+    'loop880': '',
+    'setup_loop': '(home, 0xd300, again)',
+}
+
+
+@pytest.mark.parametrize('name', sorted(
+    os.path.basename(filename)[:-4] for filename in glob.glob(os.path.join(COMPILER_DIR, 'lib', '*.asm'))))
+def test_library_entry(compiler, name):
+    result = compile_json(compiler, f'org 0xe9e0\nbackup is 0xd300\nsrc is home\nhome:\n    pop er0\n'
+                                    f'again:\n    0x1234\ninclude {name}{LIBRARY_ARGS[name]}\n')
+    assert result['length'] > 6
+
+
+def test_setup_loop_shorthand(compiler):
+    code = 'org 0xe9e0\nhome:\n    pop er0\n    0x1234\n'
+    assert compile_json(compiler, code + 'setup_loop home, 0xd300\n')['data'] == \
+        compile_json(compiler, code + 'include setup_loop(home, 0xd300, home)\n')['data']
+
+
+@pytest.mark.parametrize('line, suggestion', [
+    ('pop er9', '`pop er0`'),
+    ('sp = er6,pop er9', '`sp=er6,pop er8`'),
+])
+def test_unknown_pop_gadget(compiler, line, suggestion):
+    returncode, stdout, stderr = compiler.compile(f'org 0xe9e0\nhome:\n    {line}\n', 'json')
+    assert returncode != 0
+    assert 'Unknown gadget' in stderr and suggestion in stderr
+
+
+def test_snapshot_header(tmp_path):
+    header = {'version': 1, 'sources': [['gadgets', 1, 2]]}
+    snapshot = tmp_path / 'tables.snapshot'
+    snapshot.write_bytes(SNAPSHOT_MAGIC + json.dumps(header).encode() + b'\n{"disasm": []}')
+    assert read_snapshot(snapshot, header) == {'disasm': []}
+    # other sources, or not a snapshot at all: the tables are not read
+    assert read_snapshot(snapshot, {'version': 1, 'sources': [['gadgets', 1, 3]]}) is None
+    snapshot.write_bytes(b'\x80\x04\x95')
+    assert read_snapshot(snapshot, header) is None
+
+
+def test_snapshot_sources_by_content(tmp_path):
+    # same size and mtime, other content: the snapshot is not used
+    gadgets = tmp_path / 'gadgets'
+    gadgets.write_text('pop er0 0x1234\n')
+    header = {'version': 1, 'sources': sources_digest([str(gadgets)])}
+    snapshot = tmp_path / 'tables.snapshot'
+    snapshot.write_bytes(SNAPSHOT_MAGIC + json.dumps(header).encode() + b'\n{}')
+    st = gadgets.stat()
+    gadgets.write_text('pop er0 0x1236\n')
+    os.utime(gadgets, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert read_snapshot(snapshot, {'version': 1, 'sources': sources_digest([str(gadgets)])}) is None
+
+
+def test_assignment_without_suggestion(compiler, monkeypatch):
+    # suggestions are only looked up for an error
+    def did_you_mean(self, name):
+        raise AssertionError(f'did_you_mean({name!r})')
+    monkeypatch.setattr(NameIndex, 'did_you_mean', did_you_mean)
+    result = compile_json(compiler, 'org 0xe9e0\nhome:\n    er0 = 0x1234\n    xr0 = 0x01, 0x02, 0x0304\n')
+    assert result['length'] == 14
+
+
+EVAL_PROGRAM = 'org 0xe9e0\nhome:\n    pop er0\n    $"0x1234"\n'
+
+
+def test_evaluates_python():
+    assert evaluates_python(EVAL_PROGRAM)
+    assert not evaluates_python('home:\n    str v "$1"\n    pop er0 # $"0x1234"\n')
+
+
+def test_local_compiler_refuses_eval(compiler):
+    assert compiler.compile(EVAL_PROGRAM) == (1, '', EVAL_REFUSED)
+    assert compiler.compile_with_map(EVAL_PROGRAM, 's') == (1, '', EVAL_REFUSED, {})
+
+
+def test_pool_retires_worker_after_eval():
+    pool = CompilerPool(os.path.join(COMPILER_DIR, '580vnx'), size=1).start()
+    try:
+        worker, = pool._workers
+        returncode, stdout, stderr = pool.compile(EVAL_PROGRAM)
+        assert returncode == 0, stderr
+        assert worker not in pool._workers
+        assert pool.compile(EVAL_PROGRAM.replace('$"0x1234"', '0x1234')) == (returncode, stdout, stderr)
+    finally:
+        pool.close()
+
+
+@pytest.mark.parametrize('line, kind', [
+    ('str "ab"', 'print'),
+    ('org 0xd000', 'org'),
+    ('section data(0x10)', 'section'),
+])
+def test_library_object_unsupported(compiler, line, kind):
+    with pytest.raises(ValueError, match=f'`{kind}` is not supported in library entry test'):
+        build_object(compiler.model, 'test', ['pop er0', '0x1234', line])
@@ -0,0 +1,108 @@
+'''LRU cache of API results.
+
+A result is keyed by a hash of everything it depends on: the endpoint, the
+model, the files the model is read from and the posted source. The key is
+also used as the strong ETag of the response, so a client sending it back
+in `If-None-Match` already has the result and nothing needs to run.
+'''
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def result_key(*parts):
+    ''' Hash `parts` (str or bytes) into a hex key. '''
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # the length keeps ('ab', 'c') and ('a', 'bc') apart
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+
+_file_digests = {}  # path -> ((mtime_ns, size), digest)
+_file_digests_lock = threading.Lock()
+
+
+def file_digest(path):
+    ''' Hash of the content of `path`, read again only when its mtime or
+    size changes. A missing file hashes to ''. '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ''
+    signature = st.st_mtime_ns, st.st_size
+    cached = _file_digests.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    with _file_digests_lock:
+        _file_digests[path] = signature, digest
+    return digest
+
+
+def files_digest(paths):
+    ''' Hash of the contents of all `paths`. '''
+    return result_key(*(file_digest(path) for path in paths))
+
+
+class ResultCache:
+    ''' Response bodies by key, dropping the least recently used ones once
+    they take more than `max_bytes`. Safe to use from several threads. '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> body
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ''' Return the body cached for `key`, or None. '''
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        ''' Cache `body` (bytes) for `key`. '''
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def revalidated(self):
+        ''' Count a request answered with 304 Not Modified. '''
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+            }
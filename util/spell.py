@@ -6,11 +6,24 @@ import os, sys
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-os.chdir(BASE_DIR)
-
 if BASE_DIR not in sys.path:
     sys.path.insert(0, BASE_DIR)
 
+MAX_LENGTH = 17  # số kí tự tối đa spell được
+
+# Dữ liệu chỉ đọc một lần khi import
+with open(os.path.join(BASE_DIR, "chars_hex.json"), "r", encoding="utf-8") as file:
+    ALL_HEX_CHARS = json.load(file)
+with open(os.path.join(BASE_DIR, "chars_key.json"), "r", encoding="utf-8") as file:
+    ALL_KEY_CHARS = json.load(file)
+    file.seek(0)
+    # Phím của kí tự hex, từ các dòng dạng "<kí tự> : <phím>"
+    HEX_CHAR_KEYS = {}
+    for line in file:
+        parts = line.strip().split(" : ")
+        if len(parts) == 2:
+            HEX_CHAR_KEYS[parts[0]] = parts[1]
+
 
 def typewriter(text, delay=0.01):
     for ch in text:
@@ -159,13 +172,18 @@ def fill(hex_list):
     else:
         return filled, id, True
 
-def spell_input():
-   # typewriter("Nhập câu bạn muốn spell trên CASIO fx-580VN X: ", 0.04)
-    #time.sleep(0.04)
-    cau = sys.stdin.read().replace("\n", "")
-    while len(cau) > 17:
-        typewriter("Câu nhập quá 17 kí tự! Vui lòng nhập lại: ", 0.04)
-        cau = input()
+def spell(cau):
+    """Trả về các dòng hướng dẫn spell câu `cau` (danh sách chuỗi).
+
+    Câu dài quá MAX_LENGTH kí tự sẽ gây ra ValueError.
+    """
+    if len(cau) > MAX_LENGTH:
+        raise ValueError(f"Câu nhập quá {MAX_LENGTH} kí tự!")
+    out = []
+
+    def write(text, end="\n"):
+        out.append(f"{text}{end}")
+
     ds_chu = list(cau)
     spaces = 17 - len(cau)
     # Căn lề giữa cho câu:
@@ -199,23 +217,19 @@ def spell_input():
         elif ki_tu.isdigit():
             chars_by_key.append(ki_tu)
     # Lấy kí tự trong file
-    with open("chars_hex.json", "r") as file:
-        all_hex_chars = json.load(file) # Lấy dữ liệu
-        for char in chars_by_hex:
-            try:
-                hex_code = all_hex_chars[char]
-                typewriter(f"Hex của kí tự {char} là {hex_code}", 0.03)
-                hex_list.append(hex_code)
-            except Exception as e:
-                typewriter(f"Lỗi! Không thể tìm thấy kí tự {char}. Lỗi bắt được: {e}", 0.03)
-    with open("chars_key.json", "r") as f:
-        all_key_chars = json.load(f)
-        for char in chars_by_key:
-            try:
-                key = all_key_chars[char]
-                found_keys[char] = key
-            except Exception as e:
-                typewriter(f"Lỗi! Không thể tìm thấy phím của kí tự {char}. Lỗi bắt được: {e}", 0.03)
+    for char in chars_by_hex:
+        try:
+            hex_code = ALL_HEX_CHARS[char]
+            write(f"Hex của kí tự {char} là {hex_code}")
+            hex_list.append(hex_code)
+        except Exception as e:
+            write(f"Lỗi! Không thể tìm thấy kí tự {char}. Lỗi bắt được: {e}")
+    for char in chars_by_key:
+        try:
+            key = ALL_KEY_CHARS[char]
+            found_keys[char] = key
+        except Exception as e:
+            write(f"Lỗi! Không thể tìm thấy phím của kí tự {char}. Lỗi bắt được: {e}")
     for byte in hex_list:
         for ki_tu_hex in byte:
             if ki_tu_hex in ["A", "B", "C", "D", "E", "F"]:
@@ -223,79 +237,69 @@ def spell_input():
     hex_chars.append("C")
     hex_list.append("3C")
     hex_list.append("23")
-    with open("chars_key.json", "r", encoding="utf-8") as f:
-        lines = f.readlines()
-        found = False
-        for line in lines:
-            line = line.strip()
-            parts = line.split(" : ")
-            for char in hex_chars:
-                if len(parts) == 2:
-                    if parts[0] == char:
-                        key = parts[1]
-                        found_hex_chars[char] = key
-                        found = True
-                        break
+    for char in hex_chars:
+        if char in HEX_CHAR_KEYS:
+            found_hex_chars[char] = HEX_CHAR_KEYS[char]
     list_lo = []  # Danh sách
     filled, id, status = fill(hex_list)
     if not status:
-        typewriter("Số kí tự quá nhiều bytes, vui lòng nhập câu khác !", 0.04)
+        write("Số kí tự quá nhiều bytes, vui lòng nhập câu khác !")
     for i in filled:
         list_lo.append(i)
     # Lấp hex_list vào A, B, C
-    typewriter("Bước 1: Reset máy: \n [shift] [9] [3] [=] [=]", 0.03)
-    typewriter("Bước 2: Vào LineI/O: \n [shift] [menu] [1] [3]")
-    typewriter("Bước 3: Vào Basic Overflow: \n [x] [alpha] [CALC] [shift] [x] [x] [shift] [)] [9] [shift] [)] [9] [9] [9] [CALC] [=] [AC] [<] [del] [del] [CALC] [=] [<] [shift] [.]", 0.04)
-    typewriter("Bước 4: Lấy kí tự Hex cần thiết: ", 0.02)
+    write("Bước 1: Reset máy: \n [shift] [9] [3] [=] [=]")
+    write("Bước 2: Vào LineI/O: \n [shift] [menu] [1] [3]")
+    write("Bước 3: Vào Basic Overflow: \n [x] [alpha] [CALC] [shift] [x] [x] [shift] [)] [9] [shift] [)] [9] [9] [9] [CALC] [=] [AC] [<] [del] [del] [CALC] [=] [<] [shift] [.]")
+    write("Bước 4: Lấy kí tự Hex cần thiết: ")
     for ki_tu_hex in hex_chars:
-        print(found_hex_chars.get(ki_tu_hex, ""), end=" ")
+        write(found_hex_chars.get(ki_tu_hex, ""), end=" ")
         count += 1
-    typewriter(f" \n ([<] [9] [DEL])×{count} [del] [del] [del] ([<])×{count} [alpha] [∫]")
-    typewriter("Bước 5: Gán hex: ", 0.03)
+    write(f" \n ([<] [9] [DEL])×{count} [del] [del] [del] ([<])×{count} [alpha] [∫]")
+    write("Bước 5: Gán hex: ")
     count = 0  # Reset biến count để đếm lần 
     for i in list_lo[:]:
         if i == "A = " or i == "B = " or i == "C = ":
             list_lo.remove(i)
     for byte in list_lo:
         if byte == " n\\ 1.0000":
-            print(" n\\ [alpha] [(-)] [alpha] [CALC]", end=" ")
+            write(" n\\ [alpha] [(-)] [alpha] [CALC]", end=" ")
         elif byte == "1.":
             if count == 0:
-                print(" \n [alpha] [∫] [alpha] [□ ' \"]", end=" ")
+                write(" \n [alpha] [∫] [alpha] [□ ' \"]", end=" ")
                 count += 1
             elif count == 1:
-                print(" \n [alpha] [∫] [alpha] [x⁻¹]", end=" ")
+                write(" \n [alpha] [∫] [alpha] [x⁻¹]", end=" ")
         elif byte == ' n\\ x:':
-            print(" n\\ [x] [alpha] [∫]")
+            write(" n\\ [x] [alpha] [∫]")
         elif byte == " ":
             pass
         else:
             for ki_tu in byte:
                 if ki_tu.isdigit():
-                    print(f"[{ki_tu}]", end=" ")
+                    write(f"[{ki_tu}]", end=" ")
                 elif ki_tu in ["A", "B", "C", "D", "E", "F"]:
-                    print("[>]", end=" ")
+                    write("[>]", end=" ")
                 elif ki_tu == ".":
-                    print("[.]", end=" ")
+                    write("[.]", end=" ")
                 elif byte == "×10":
-                    print("[×10]", end=" ")
+                    write("[×10]", end=" ")
                     break
-    typewriter(f" \n [CALC] ([=])x{id + 2}", 0.04)
-    typewriter("Bước 6: Lấy 'an': \n [x] [alpha] [CALC] [shift] [x] [x] [shift] [)] [9] [shift] [)] [9] [CALC] [=] [<] [shift] [.] [shift] [.] [<] [<] [DEL] [v] [shift] [8] [v] [2] [6] [<] [<] [>] [9] [DEL] [<] [)] [+] [100 số bất kì]\n[CALC] [=]", 0.04)
-    typewriter("Bước 7: Lấy '@': \n [x] [alpha] [CALC] [shift] [x] [x] [shift] [)] [9] [shift] [)] [9] [CALC] [=] [<] [shift] [.]", 0.02)
+    write(f" \n [CALC] ([=])x{id + 2}")
+    write("Bước 6: Lấy 'an': \n [x] [alpha] [CALC] [shift] [x] [x] [shift] [)] [9] [shift] [)] [9] [CALC] [=] [<] [shift] [.] [shift] [.] [<] [<] [DEL] [v] [shift] [8] [v] [2] [6] [<] [<] [>] [9] [DEL] [<] [)] [+] [100 số bất kì]\n[CALC] [=]")
+    write("Bước 7: Lấy '@': \n [x] [alpha] [CALC] [shift] [x] [x] [shift] [)] [9] [shift] [)] [9] [CALC] [=] [<] [shift] [.]")
     if id == 0:
-        typewriter('[shift] [7] [4] [8]', 0.03)
-        typewriter('([<] [9] [DEL])×1\n[DEL]×10', 0.02)
-        typewriter('[<] [9 số bất kì] [>] [alpha] [∫] [>] [alpha] [CALC] [alpha] [(-)]\n[CALC] ([=])×2 [^]', 0.04)
+        write('[shift] [7] [4] [8]')
+        write('([<] [9] [DEL])×1\n[DEL]×10')
+        write('[<] [9 số bất kì] [>] [alpha] [∫] [>] [alpha] [CALC] [alpha] [(-)]\n[CALC] ([=])×2 [^]')
     elif id == 1:
-        typewriter('[shift] [7] [4] [8] [shift] [7] [4] [9]', 0.02)
-        typewriter('([<] [9] [DEL])×2\n[DEL]×10', 0.02)
-        typewriter('[<] [9 số bất kì] [>] [alpha] [∫] [>] [alpha] [CALC] [alpha] [(-)] [alpha] [∫] [>] [alpha] [CALC] [alpha] [□ \' "]\n[CALC] ([=])×3 [^]', 0.04)
+        write('[shift] [7] [4] [8] [shift] [7] [4] [9]')
+        write('([<] [9] [DEL])×2\n[DEL]×10')
+        write('[<] [9 số bất kì] [>] [alpha] [∫] [>] [alpha] [CALC] [alpha] [(-)] [alpha] [∫] [>] [alpha] [CALC] [alpha] [□ \' "]\n[CALC] ([=])×3 [^]')
     elif id == 2:
-        typewriter('[shift] [7] [4] [8] [shift] [7] [4] [9] [shift] [7] [1] [4]', 0.04)
-        typewriter('([<] [9] [DEL])×3\n[DEL]×10', 0.03)
-        typewriter('[<] [9 số bất kì] [>] [alpha] [∫] [>] [alpha] [CALC] [alpha] [(-)] [alpha] [∫] [>] [alpha] [CALC] [alpha] [□ \' "] [alpha] [∫] [>] [alpha] [CALC] [alpha] [x^-1]\n[CALC] ([=])×4 [^]', 0.04)
-    typewriter('Bước 8: Xóa bytes thừa:', 0.02)
+        write('[shift] [7] [4] [8] [shift] [7] [4] [9] [shift] [7] [1] [4]')
+        write('([<] [9] [DEL])×3\n[DEL]×10')
+        write('[<] [9 số bất kì] [>] [alpha] [∫] [>] [alpha] [CALC] [alpha] [(-)] [alpha] [∫] [>] [alpha] [CALC] [alpha] [□ \' "] [alpha] [∫] [>] [alpha] [CALC] [alpha] [x^-1]\n[CALC] ([=])×4 [^]')
+    write('Bước 8: Xóa bytes thừa:')
     list_lo.reverse()
     if " x:\n" in list_lo:
         list_lo.remove(" x:\n")
@@ -305,46 +309,55 @@ def spell_input():
     for i in list_lo:
         if i == '20':
             if count == 0:
-                print("[DEL]", end=" ")
+                write("[DEL]", end=" ")
             else:
-                print(f"[<]x{count} [DEL]", end=" ")
+                write(f"[<]x{count} [DEL]", end=" ")
             count = 0
         elif i == '1.':
             if count == 0:
-                print("[DEL]x2", end=" ")
+                write("[DEL]x2", end=" ")
             else:
-                print(f"[<]x{count} [DEL]x2", end=" ")
+                write(f"[<]x{count} [DEL]x2", end=" ")
             count = 0
         elif i == '1.0000':
             if count != 0:
-                print(f"[<]x{count}", end=" ")
+                write(f"[<]x{count}", end=" ")
             count = 0
         elif i == '×10' or i == "F4":
             pass
         else:
             count += 1
-    typewriter("\nBước 9: Gán chữ: ")
+    write("\nBước 9: Gán chữ: ")
     b = 0  # Biến đếm khi có kí tự 2 bytes
     for char in ds_chu:
         if char in found_keys:
-            typewriter(found_keys[char],0.04)
+            write(found_keys[char])
         elif char not in found_keys:
             # Tại sao dấu cách không có trong found_keys ? Do idk :)))
             if char == " ":
-                typewriter("[shift] [8] [3] [4]", 0.04)
+                write("[shift] [8] [3] [4]")
                 b+=1
             elif char not in all_ascii_chars:
-                typewriter("[>]", 0.04)
-                time.sleep(0.8)
+                write("[>]")
                 b+=1 #Do không nằm trong kí tự Tiếng Anh và các kí tự ascii
             elif char in all_ascii_chars:
                 if char in chars_by_hex:
-                    typewriter("[>]",0.04)
-                    time.sleep(0.8)
-    typewriter(f" \n [{17-b} số bất kì] [shift] [(] [2] [x], việc còn lại là bấm [calc] [=]")
-    typewriter("-----HẾT-----")
-    typewriter("Coder Feature & FixCode: Phong2k11®", 0.04)
-    typewriter("Coder Tool Spell & Update: AxesMC", 0.04)
+                    write("[>]")
+    write(f" \n [{17-b} số bất kì] [shift] [(] [2] [x], việc còn lại là bấm [calc] [=]")
+    write("-----HẾT-----")
+    write("Coder Feature & FixCode: Phong2k11®")
+    write("Coder Tool Spell & Update: AxesMC")
+    return "".join(out).split("\n")[:-1]
+
+def spell_input():
+   # typewriter("Nhập câu bạn muốn spell trên CASIO fx-580VN X: ", 0.04)
+    #time.sleep(0.04)
+    cau = sys.stdin.read().replace("\n", "")
+    while len(cau) > MAX_LENGTH:
+        typewriter("Câu nhập quá 17 kí tự! Vui lòng nhập lại: ", 0.04)
+        cau = input()
+    sys.stdout.write("".join(f"{line}\n" for line in spell(cau)))
+
 """def main():
     show_menu()  # Hiện menu
     while True: